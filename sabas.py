@@ -16,6 +16,11 @@ from PyQt5.QtGui import QIcon
  # QPalette, QColor
 
 from sabas_core import sabas_core
+from sabas_catalog import sabas_catalog
+from sabas_format import default_parallel
+from sabas_trace import trace
+from sabas_history import throughput_recorder, image_type, format_eta
+from sabas_source import source_exists, is_stream
 
 
 ''' 
@@ -52,6 +57,8 @@ class sabas(QMainWindow):
 	# cline_flag = False
 	# Should we check SHA1 
 	checksum_flag = False	
+	# Catalog ID of the selected image, if it was selected from the catalog
+	catalog_id = None
 
 	def __init__(self, parent=None):
 		super(sabas, self).__init__(parent)
@@ -81,12 +88,79 @@ class sabas(QMainWindow):
 		'''
 		
 		parser = argparse.ArgumentParser(description="Sabas - a small ISO to USB writing tool")
-		parser.add_argument("-i", "--input", type=str, help="Used to specify the input file")
+		parser.add_argument("-i", "--input", type=str, help="Used to specify the input file, - for stdin, a named pipe or an http(s) URL")
 		parser.add_argument("-o", "--output", type=str, help="Used to specify the drive to write to")
-		parser.add_argument("-s", "--storage", type=str, help="Used to create storage drive, used in conjunction with -f.\nExample -s /dev/sdX")
+		parser.add_argument("-s", "--storage", type=str, help="Used to create storage drive, used in conjunction with -f.\nExample -s /dev/sdX" \
+							+ "\nSeveral drives can be given as a comma separated list of drives or serials, or all for every USB drive")
+		parser.add_argument("--parallel", type=int, help="Number of drives formatted at once by -s, defaults to 4")
 		parser.add_argument("-f", "--filesystem", type=str, help="Optional. Options are fat32, ntfs or exfat. Defaults to ntfs")
+		parser.add_argument("-c", "--catalog-id", type=int, help="Used instead of -i to write an image selected by its catalog ID")
+		parser.add_argument("--catalog-add", type=str, metavar="DIR", help="Adds a directory to the image catalog")
+		parser.add_argument("--catalog-scan", action="store_true", help="Rescans the catalog directories for new or changed images")
+		parser.add_argument("--catalog-hash", action="store_true", help="Calculate image digests when rescanning the catalog")
+		parser.add_argument("--catalog-search", type=str, metavar="TEXT", help="Lists catalogued images whose name or label contain TEXT")
+		parser.add_argument("--cache-budget", type=int, metavar="MB", help="Write without dd, keeping the page cache used within MB megabytes")
+		parser.add_argument("--health", type=str, metavar="DRIVE", help="Checks a drive for fake capacity and dead regions.\nExample --health /dev/sdX")
+		parser.add_argument("--exhaustive", action="store_true", help="Used with --health to check every block instead of a sample")
+		parser.add_argument("--capture", type=str, metavar="FILE", help="Captures a drive to an image file, .xz and .zst files are compressed.\nUsed with -o or asks for the drive")
+		parser.add_argument("--trim", action="store_true", help="Used with --capture to stop at the end of the last partition")
+		parser.add_argument("--threads", type=int, help="Number of compression threads used by --capture, defaults to the number of cores")
+		parser.add_argument("--manifest", action="store_true", help="Creates the chunk manifest for the input file and exits")
+		parser.add_argument("--verify", action="store_true", help="Verifies the drive against the image's manifest after writing")
+		parser.add_argument("--spot-check", type=int, metavar="N", help="Verifies N randomly chosen chunks after writing")
+		parser.add_argument("--queue-depth", type=int, metavar="N", help="Write and verify without dd, keeping N requests in flight")
+		parser.add_argument("--io-backend", type=str, default="auto", help="Used with --queue-depth. Options are auto, io_uring, threads or sequential")
+		parser.add_argument("--trace", type=str, metavar="FILE", help="Saves a Chrome trace of each phase to FILE, or set SABAS_TRACE=FILE")
+		parser.add_argument("--profile", type=str, metavar="PHASE", help="Used with --trace to profile a phase, for example write or checksum")
 		args = parser.parse_args()
 
+		if args.trace:
+			trace.enable(args.trace, args.profile)
+
+		# Check a drive before it's trusted with an image
+		if args.health:
+			if "/dev/" not in args.health:
+				raise ValueError("Please input a correct drive name. For example /dev/sdX")
+
+			self.sabas_obj.selection = args.health
+			self.sabas_obj.check_health(args.exhaustive)
+			exit()
+
+		# Snapshot a drive to an image
+		if args.capture:
+			if args.cache_budget:
+				self.sabas_obj.cache_budget = args.cache_budget * 1024 * 1024
+
+			if args.output:
+				if "/dev/" not in args.output:
+					raise ValueError("Please input a correct drive name. For example /dev/sdX")
+				self.sabas_obj.selection = args.output
+			else:
+				self.sabas_obj.find_drives()
+				self.sabas_obj.drive_selection()
+
+			self.sabas_obj.capture(args.capture, args.trim, args.threads)
+			exit()
+
+		# Catalog maintenance can be done without writing anything
+		if args.catalog_add or args.catalog_scan or args.catalog_search is not None:
+			self.catalog_commands(args)
+			exit()
+
+		# Select the input file from the catalog
+		if args.catalog_id is not None:
+			catalog = sabas_catalog()
+			args.input = catalog.get(args.catalog_id)["path"]
+			catalog.close()
+
+		# Hash an image without writing it
+		if args.manifest:
+			if not args.input or not os.path.isfile(args.input):
+				parser.error("--manifest needs an input file.")
+
+			self.sabas_obj.create_manifest(args.input)
+			exit()
+
 		# If the command line is going to be used instead of the GUI we need
 		# both input and output data
 		if args.input and args.output is None:
@@ -95,14 +169,26 @@ class sabas(QMainWindow):
    		# If we want to write an ISO straight to a drive
 		elif args.input and args.output and not args.storage:			
 			self.sabas_obj.cline_flag = True
-			# Check the input file exists
-			if not os.path.isfile(args.input):
+			# Check the input file exists, streams are written as they arrive
+			if not source_exists(args.input):
 				raise FileNotFoundError(args.input + " not found.")
+
+			if is_stream(args.input) and args.spot_check:
+				parser.error("--spot-check needs an image file, use --verify with streamed images.")
 			
 			self.sabas_obj.iso_filename = args.input
 
+			if args.cache_budget:
+				self.sabas_obj.cache_budget = args.cache_budget * 1024 * 1024
+
+			self.sabas_obj.queue_depth = args.queue_depth
+			self.sabas_obj.io_backend = args.io_backend
+
+			self.sabas_obj.verify_flag = args.verify
+			self.sabas_obj.spot_check = args.spot_check
+
 			# Check we have a decent drive path
-			if "/dev/" not in args.storage:
+			if "/dev/" not in args.output:
 				raise ValueError("Please input a correct drive name. For example /dev/sdc")
 
 			self.sabas_obj.selection = args.output
@@ -114,12 +200,6 @@ class sabas(QMainWindow):
 		# Default to ntfs
 		elif args.storage:
 			
-			# Check we have a decent drive path
-			if "/dev/" not in args.storage:
-				raise ValueError("Please input a correct drive name. For example /dev/sdX")
-
-			self.sabas_obj.selection = args.storage
-
 			filesystem = ""
 			
 			if args.filesystem:
@@ -127,6 +207,13 @@ class sabas(QMainWindow):
 			else:
 				filesystem = "ntfs"
 
+			# Format a tray of drives at once
+			if args.storage == "all" or "," in args.storage or "/dev/" not in args.storage:
+				self.sabas_obj.create_storage_drives(args.storage, filesystem, args.parallel or default_parallel)
+				exit()
+
+			self.sabas_obj.selection = args.storage
+
 			self.sabas_obj.create_storage_drive(filesystem)
 			# Close after we've finished
 			exit()
@@ -138,6 +225,28 @@ class sabas(QMainWindow):
 			self.initial_selection()
 			
 
+	def catalog_commands(self, args):
+		''' Adds directories to, rescans and searches the image catalog from the command line '''
+
+		catalog = sabas_catalog()
+
+		if args.catalog_add:
+			catalog.add_directory(args.catalog_add)
+			print("Added " + args.catalog_add + " to the catalog")
+
+		if args.catalog_add or args.catalog_scan:
+			print("Scanning catalog directories...")
+			added, updated, removed, unchanged = catalog.scan(args.catalog_hash)
+			print("Added " + str(added) + ", updated " + str(updated) + ", removed " + str(removed) \
+				+ ", unchanged " + str(unchanged))
+
+		if args.catalog_search is not None:
+			for row in catalog.search(args.catalog_search):
+				print(catalog.describe(row))
+
+		catalog.close()
+
+
 	def initial_selection(self):
 		'''	Sets the first drive found to the selected one '''
 
@@ -240,6 +349,9 @@ class sabas(QMainWindow):
 		# Create a process for writing
 		self.write_process = QProcess(self)
 
+		# Connected once here, do_write runs for every write in the session
+		self.write_process.finished.connect(self.record_job)
+
 		# Top line is independent of these functions and is added below
 		
 		# Create each group in turn
@@ -331,7 +443,13 @@ class sabas(QMainWindow):
 		if self.checksum_flag:
 			self.update_statusbar("Calculating checksum...")
 			
-			self.sha1_checksum = self.sabas_obj.get_checksum(self.iso_filename)
+			# Catalogued images only need hashing once
+			if self.catalog_id is not None:
+				catalog = sabas_catalog()
+				self.sha1_checksum = catalog.get_sha1(self.catalog_id)
+				catalog.close()
+			else:
+				self.sha1_checksum = self.sabas_obj.get_checksum(self.iso_filename)
 			
 			file_info += "SHA1 : " + self.sha1_checksum
 			
@@ -464,6 +582,10 @@ class sabas(QMainWindow):
 		# So we read everything coming out of dd
 		self.write_process.setProcessChannelMode(QProcess.MergedChannels)		
 
+		# Record the job's throughput to predict how long it will take
+		self.recorder = throughput_recorder()
+		self.identity = self.sabas_obj.get_identity()
+
 		# Pass the QProcess and filename to the sabas_core function
 		self.sabas_obj.write_dd(self.iso_filename, self.write_process)
 
@@ -474,6 +596,19 @@ class sabas(QMainWindow):
 		self.write_process.finished.connect(lambda: self.update_statusbar("Finished"))	
 
 
+	def record_job(self, exit_code=0, exit_status=None):
+		''' Saves the finished write's throughput to the history '''
+
+		self.progress_bar.setFormat("%p%")
+
+		# Failed writes would only mislead future predictions
+		if exit_code != 0:
+			return
+
+		self.recorder.finish(self.iso_fstat.st_size)
+		self.sabas_obj.record_job(self.identity, image_type(self.iso_filename), self.recorder)
+
+
 	def create_iso_box(self):
 		'''
 		This creates the box display information
@@ -507,6 +642,7 @@ class sabas(QMainWindow):
 			filename = QFileDialog.getOpenFileName(self, 'Open file', '~')
 		
 			self.iso_filename = filename[0]
+			self.catalog_id = None
 			self.file_info = self.get_file_info()
 		
 			# Refresh the file information box
@@ -518,6 +654,38 @@ class sabas(QMainWindow):
 		except OSError as e:
 			print("Error, no file selected.")
 
+	def catalog_dialog(self):
+		'''
+		Searches the image catalog by name or volume label and
+		selects the chosen image for writing
+		'''
+
+		search_text, ok_pressed = QInputDialog.getText(self, "Catalog", "Search by name or label : ", QLineEdit.Normal, "")
+
+		if not ok_pressed:
+			return
+
+		catalog = sabas_catalog()
+		results = catalog.search(search_text)
+		descriptions = [catalog.describe(row) for row in results]
+
+		if not descriptions:
+			self.update_statusbar("No catalogued images match " + search_text)
+			catalog.close()
+			return
+
+		chosen, ok_pressed = QInputDialog.getItem(self, "Catalog", "Select an image : ", descriptions, 0, False)
+
+		if ok_pressed:
+			self.catalog_id = results[descriptions.index(chosen)]["id"]
+			self.iso_filename = results[descriptions.index(chosen)]["path"]
+
+			self.write_button.setDisabled(False)
+			# Update the ISO info text
+			self.refresh_file_info()
+
+		catalog.close()
+
 	# def call_format_restore(self):
 	# 	'''
 	# 		Controls the formatting of the drive to a USB storage device			
@@ -531,12 +699,14 @@ class sabas(QMainWindow):
 
 		# Make some buttons
 		self.open_button = QPushButton("Open")
+		self.catalog_button = QPushButton("Catalog")
 		self.write_button = QPushButton("Write")
 
 		# self.format_button = QPushButton("Format")
 
 		# Connect some buttons
 		self.open_button.clicked.connect(self.file_open_dialog)
+		self.catalog_button.clicked.connect(self.catalog_dialog)
 		self.write_button.clicked.connect(self.write_usb)
 
 		# Initially set to be disabled		
@@ -544,6 +714,7 @@ class sabas(QMainWindow):
 
 		conf_layout = QHBoxLayout()
 		conf_layout.addWidget(self.open_button)
+		conf_layout.addWidget(self.catalog_button)
 		conf_layout.addWidget(self.write_button)
 		conf_layout.addStretch(1)
 
@@ -572,6 +743,11 @@ class sabas(QMainWindow):
 				progress = 100 * (int(bytes_written)/int(iso_in_bytes))
 				self.progress_bar.setValue(progress)
 
+				self.recorder.update(int(bytes_written))
+				eta = self.sabas_obj.get_history().predict_eta(self.identity, image_type(self.iso_filename),
+																self.recorder, iso_in_bytes)
+				self.progress_bar.setFormat("%p% - ETA " + format_eta(eta))
+
 
 if __name__ == '__main__':
 
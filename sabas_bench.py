@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from sabas_io import copy_image, copy_image_queued, get_backend, cache_policy, cache_monitor
+from sabas_manifest import create_manifest, verify_device
+
+
+'''
+Benchmarks for the sabas write paths
+
+Run against regular files in a temporary directory by default, or
+against a loop device or spare drive with --target. Anything on the
+target is overwritten.
+'''
+
+
+def make_source(directory, size):
+	''' Creates a file of size bytes of random data to copy from '''
+
+	path = os.path.join(directory, "source.img")
+	block = os.urandom(4 * 1024 * 1024)
+
+	with open(path, 'wb') as f:
+		remaining = size
+		while remaining > 0:
+			f.write(block[:min(remaining, len(block))])
+			remaining -= len(block)
+		os.fsync(f.fileno())
+
+	return path
+
+
+def drop_source(path):
+	''' Drops the source from the page cache so each run starts cold '''
+
+	fd = os.open(path, os.O_RDONLY)
+	os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+	os.close(fd)
+
+
+def bench_cache(source, target, budget):
+	''' Compares the page cache growth of a plain copy with a budgeted one '''
+
+	results = []
+
+	for name, policy in (("no cache policy", None), ("cache budget", cache_policy(budget))):
+		drop_source(source)
+		monitor = cache_monitor()
+
+		start = time.perf_counter()
+		written = copy_image(source, target, policy=policy, monitor=monitor)
+		elapsed = time.perf_counter() - start
+
+		results.append((name, written, elapsed, monitor.peak))
+
+	return results
+
+
+def bench_backends(source, target, depths, backends=("threads", "io_uring")):
+	'''
+	Compares the sequential write and verify paths with the queued
+	backends at each queue depth
+	'''
+
+	manifest = create_manifest(source)
+	runs = [("sequential", 1)] + [(name, depth) for name in backends for depth in depths]
+	results = []
+
+	for name, depth in runs:
+		try:
+			backend = get_backend(name, depth)
+		except OSError as err:
+			print(name + " unavailable : " + str(err))
+			continue
+
+		drop_source(source)
+		start = time.perf_counter()
+		written = copy_image_queued(source, target, backend)
+		results.append((name + " write, depth " + str(depth), written, time.perf_counter() - start, None))
+
+		drop_source(target)
+		start = time.perf_counter()
+		mismatched = verify_device(target, manifest, backend=get_backend(name, depth))
+		results.append((name + " verify, depth " + str(depth), manifest["size"], time.perf_counter() - start, None))
+
+		if mismatched:
+			print(name + " wrote " + str(len(mismatched)) + " chunks incorrectly")
+
+	return results
+
+
+def print_results(results):
+	for name, written, elapsed, peak in results:
+		line = "{:<28} {:>8.1f} MB/s".format(name, written / elapsed / (1024 * 1024))
+		if peak is not None:
+			line += "  peak page cache growth {:>8.1f} MB".format(peak / (1024 * 1024))
+		print(line)
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Sabas write path benchmarks")
+	parser.add_argument("--size", type=int, default=1024, help="Size of the test image in MB")
+	parser.add_argument("--target", type=str, help="File or device to write to, defaults to a temporary file")
+	parser.add_argument("--budget", type=int, default=64, help="Page cache budget in MB")
+	parser.add_argument("--depths", type=str, default="1,4,8,16", help="Comma separated queue depths to compare")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		source = make_source(directory, args.size * 1024 * 1024)
+		target = args.target or os.path.join(directory, "target.img")
+
+		print("Page cache use writing " + str(args.size) + " MB to " + target)
+		print_results(bench_cache(source, target, args.budget * 1024 * 1024))
+
+		print("\nQueue depth writing and verifying " + str(args.size) + " MB on " + target)
+		print_results(bench_backends(source, target, [int(depth) for depth in args.depths.split(",")]))
+
+	sys.exit(0)
@@ -0,0 +1,284 @@
+import os
+import lzma
+import struct
+import concurrent.futures
+
+from sabas_io import get_size, cache_policy
+from sabas_trace import trace
+
+# zstandard is optional, without it images can be captured raw or as xz
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+# Size of each read from the drive
+read_size = 4 * 1024 * 1024
+
+# Smallest run of zeros left as a hole in raw images
+hole_size = 64 * 1024
+
+# Each block is compressed independently so blocks can be compressed in parallel
+compress_block_size = 16 * 1024 * 1024
+
+sector_size = 512
+
+
+def last_used_byte(fd, sector_size=sector_size):
+	'''
+	Returns the end of the last partition in the drive's partition
+	table, or of the ISO 9660 filesystem for drives written from a
+	hybrid ISO, whichever is further. Returns None if the drive has
+	no partition table.
+
+	The backup GPT header at the end of the drive is not included.
+	'''
+
+	mbr = os.pread(fd, sector_size, 0)
+
+	if len(mbr) < 512 or mbr[510:512] != b'\x55\xaa':
+		return None
+
+	last = 0
+	gpt = False
+
+	for i in range(4):
+		entry = mbr[446 + 16 * i:446 + 16 * (i + 1)]
+		part_type = entry[4]
+		start, count = struct.unpack_from("<II", entry, 8)
+
+		if part_type == 0xee:
+			gpt = True
+		elif part_type != 0:
+			last = max(last, (start + count) * sector_size)
+
+	if gpt:
+		header = os.pread(fd, 92, sector_size)
+		if header[:8] != b'EFI PART':
+			return None
+
+		entries_lba, = struct.unpack_from("<Q", header, 72)
+		entry_count, entry_size = struct.unpack_from("<II", header, 80)
+		entries = os.pread(fd, entry_count * entry_size, entries_lba * sector_size)
+
+		# The table itself has to be kept
+		last = max(last, entries_lba * sector_size + entry_count * entry_size)
+
+		for i in range(entry_count):
+			entry = entries[i * entry_size:(i + 1) * entry_size]
+			if len(entry) < 48 or entry[:16] == bytes(16):
+				continue
+			last_lba, = struct.unpack_from("<Q", entry, 40)
+			last = max(last, (last_lba + 1) * sector_size)
+
+	# Hybrid ISOs have an ISO 9660 filesystem that may extend past the partitions
+	descriptor = os.pread(fd, 2048, 16 * 2048)
+	if descriptor[1:6] == b'CD001' and descriptor[0] == 1:
+		volume_blocks, = struct.unpack_from("<I", descriptor, 80)
+		block_size, = struct.unpack_from("<H", descriptor, 128)
+		last = max(last, volume_blocks * block_size)
+
+	# Round up to a whole sector
+	return -(-last // sector_size) * sector_size
+
+
+def read_blocks(fd, length, policy=None, progress=None):
+	''' Yields (offset, data) for each block of the first length bytes of the drive '''
+
+	window = policy.open_source(fd) if policy else None
+	offset = 0
+
+	while offset < length:
+		with trace.span("read block", bytes=min(read_size, length - offset)):
+			data = os.pread(fd, min(read_size, length - offset), offset)
+		if not data:
+			break
+
+		yield offset, data
+		offset += len(data)
+
+		if window:
+			window.advance(offset)
+		if progress:
+			progress(offset, length)
+
+	if window:
+		window.finish()
+
+
+def write_sparse(blocks, output_fd):
+	'''
+	Writes the blocks to a raw image, leaving runs of zeros as holes
+
+	Returns the number of bytes actually written
+	'''
+
+	zeros = bytes(hole_size)
+	zero_block = bytes(read_size)
+	stored = 0
+
+	for offset, data in blocks:
+		view = memoryview(data)
+
+		# Blocks that are entirely zero are skipped with a single compare
+		if data == zero_block or (len(data) < read_size and data == bytes(len(data))):
+			continue
+
+		for start in range(0, len(data), hole_size):
+			piece = view[start:start + hole_size]
+			if piece != zeros[:len(piece)]:
+				os.pwrite(output_fd, piece, offset + start)
+				stored += len(piece)
+
+	return stored
+
+
+def _regroup(blocks, size):
+	''' Regroups the drive's blocks into blocks of size bytes for compression '''
+
+	pending = []
+	pending_size = 0
+
+	for offset, data in blocks:
+		pending.append(data)
+		pending_size += len(data)
+
+		if pending_size >= size:
+			joined = b"".join(pending)
+			# A single block from the drive may fill several
+			start = 0
+			while pending_size - start >= size:
+				yield joined[start:start + size]
+				start += size
+			pending = [joined[start:]]
+			pending_size -= start
+
+	if pending_size:
+		yield b"".join(pending)
+
+
+def _compress_xz(block, preset):
+	with trace.span("compress block", bytes=len(block)):
+		return lzma.compress(block, preset=preset)
+
+
+def write_xz(blocks, output_file, threads, preset=3):
+	'''
+	Compresses the blocks with xz in parallel
+
+	Each block becomes an independent xz stream, the concatenated
+	streams form a valid .xz file that xz and lzma can decompress.
+	lzma releases the GIL while compressing so the blocks are spread
+	across threads. Zero blocks are only compressed once.
+
+	Returns the number of bytes written
+	'''
+
+	stored = 0
+	zero_block = bytes(compress_block_size)
+	compressed_zero = None
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+		in_flight = []
+
+		for block in _regroup(blocks, compress_block_size):
+			if block == zero_block:
+				if compressed_zero is None:
+					compressed_zero = executor.submit(_compress_xz, block, preset)
+				in_flight.append(compressed_zero)
+			else:
+				in_flight.append(executor.submit(_compress_xz, block, preset))
+
+			# Bound the memory used by blocks waiting to be written, keeping the output in order
+			while len(in_flight) > 2 * threads:
+				compressed = in_flight.pop(0).result()
+				output_file.write(compressed)
+				stored += len(compressed)
+
+		for future in in_flight:
+			compressed = future.result()
+			output_file.write(compressed)
+			stored += len(compressed)
+
+	return stored
+
+
+def write_zstd(blocks, output_file, threads, level=3):
+	'''
+	Compresses the blocks with zstd, which splits the input into jobs
+	that are compressed on threads worker threads
+
+	Returns the number of bytes written
+	'''
+
+	if zstandard is None:
+		raise ValueError("Error : the zstandard module is needed to capture .zst images, use .xz instead.")
+
+	compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+	start = output_file.tell()
+
+	with compressor.stream_writer(output_file, closefd=False) as writer:
+		for offset, data in blocks:
+			writer.write(data)
+
+	return output_file.tell() - start
+
+
+def capture_drive(device, output, trim=False, threads=None, cache_budget=None, progress=None):
+	'''
+	Captures a drive to an image file
+
+	The format is chosen by the output extension, .xz and .zst images
+	are compressed in parallel, anything else is written as a raw
+	image with runs of zeros left as sparse holes.
+
+	Arguments:
+
+	trim         -- only capture up to the end of the last partition
+	threads      -- compression threads, defaults to the number of cores
+	cache_budget -- limits the page cache used reading the drive
+	progress     -- called with (bytes read, bytes to read)
+
+	Returns a tuple of (bytes read, bytes stored)
+	'''
+
+	# Check before the output is opened, which would truncate it
+	if output.endswith(".zst") and zstandard is None:
+		raise ValueError("Error : the zstandard module is needed to capture .zst images, use .xz instead.")
+
+	threads = threads or os.cpu_count() or 1
+	policy = cache_policy(cache_budget) if cache_budget else None
+
+	fd = os.open(device, os.O_RDONLY)
+
+	try:
+		length = get_size(fd)
+
+		if trim:
+			used = last_used_byte(fd)
+			if used is None:
+				print("No partition table found, capturing the whole drive")
+			else:
+				length = min(length, used)
+
+		blocks = read_blocks(fd, length, policy, progress)
+
+		if output.endswith(".xz"):
+			with open(output, 'wb') as f:
+				stored = write_xz(blocks, f, threads)
+		elif output.endswith(".zst"):
+			with open(output, 'wb') as f:
+				stored = write_zstd(blocks, f, threads)
+		else:
+			output_fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+			try:
+				stored = write_sparse(blocks, output_fd)
+				os.ftruncate(output_fd, length)
+			finally:
+				os.close(output_fd)
+
+	finally:
+		os.close(fd)
+
+	return (length, stored)
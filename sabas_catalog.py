@@ -0,0 +1,349 @@
+import os
+import sqlite3
+import hashlib
+import struct
+import time
+
+
+# Where the catalog database lives unless another path is given
+default_catalog_path = os.path.join(os.path.expanduser("~"), ".sabas", "catalog.db")
+
+# Files with these extensions are added to the catalog when scanning
+image_extensions = (".iso", ".img")
+
+# ISO 9660 volume descriptors start at sector 16 and are 2048 bytes each
+iso_sector_size = 2048
+iso_descriptor_start = 16 * iso_sector_size
+
+
+def read_image_info(filename):
+	'''
+	Reads the volume label and boot type of an image without reading
+	the whole file, only the MBR, the ISO volume descriptors and the
+	El Torito boot catalog are read
+
+	Returns a tuple of (label, boot_type), label is None for images
+	without an ISO 9660 primary volume descriptor
+	'''
+
+	label = None
+	el_torito = False
+	platforms = set()
+
+	with open(filename, 'rb') as f:
+		mbr = f.read(1024)
+		hybrid = len(mbr) >= 512 and mbr[510:512] == b'\x55\xaa'
+		gpt = mbr[512:520] == b'EFI PART'
+
+		# Walk the volume descriptor set until the terminator
+		catalog_lba = None
+		for i in range(32):
+			f.seek(iso_descriptor_start + i * iso_sector_size)
+			descriptor = f.read(iso_sector_size)
+
+			if len(descriptor) < iso_sector_size or descriptor[1:6] != b'CD001':
+				break
+
+			descriptor_type = descriptor[0]
+
+			if descriptor_type == 0 and descriptor[7:30] == b'EL TORITO SPECIFICATION':
+				el_torito = True
+				catalog_lba = struct.unpack_from("<I", descriptor, 0x47)[0]
+			elif descriptor_type == 1:
+				label = descriptor[40:72].decode("ascii", "replace").strip() or None
+			elif descriptor_type == 255:
+				break
+
+		# The boot catalog tells us which platforms the image boots on
+		if catalog_lba:
+			f.seek(catalog_lba * iso_sector_size)
+			boot_catalog = f.read(iso_sector_size)
+
+			for offset in range(0, len(boot_catalog) - 31, 32):
+				entry_type = boot_catalog[offset]
+				# Validation entry or section headers carry the platform ID
+				if entry_type in (0x01, 0x90, 0x91):
+					platforms.add(boot_catalog[offset + 1])
+				elif offset > 0 and entry_type not in (0x00, 0x88, 0x44):
+					break
+
+	boot = []
+	if el_torito:
+		if 0x00 in platforms or not platforms:
+			boot.append("bios")
+		if 0xef in platforms:
+			boot.append("uefi")
+		if hybrid:
+			boot.append("hybrid")
+	elif gpt:
+		boot.append("gpt")
+	elif hybrid:
+		boot.append("mbr")
+	else:
+		boot.append("none")
+
+	return (label, " ".join(boot))
+
+
+def get_digests(filename):
+	''' Returns a tuple of the SHA1 and SHA256 hashes of the file given by filename '''
+
+	buffer_size = 1024 * 1024
+
+	sha1 = hashlib.sha1()
+	sha256 = hashlib.sha256()
+
+	with open(filename, 'rb') as f:
+		while True:
+			data = f.read(buffer_size)
+			if not data:
+				break
+			sha1.update(data)
+			sha256.update(data)
+
+	return (sha1.hexdigest(), sha256.hexdigest())
+
+
+class sabas_catalog():
+	'''
+	A SQLite backed catalog of the images held in a set of directories
+
+	Rescans are incremental, a file is only re-read if its size or
+	modification time has changed since it was last catalogued
+	'''
+
+	schema = '''
+		CREATE TABLE IF NOT EXISTS directories (
+			path TEXT PRIMARY KEY
+		);
+		CREATE TABLE IF NOT EXISTS images (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			path TEXT UNIQUE NOT NULL,
+			directory TEXT NOT NULL,
+			name TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			mtime_ns INTEGER NOT NULL,
+			sha1 TEXT,
+			sha256 TEXT,
+			label TEXT,
+			boot_type TEXT,
+			scanned REAL
+		);
+		CREATE INDEX IF NOT EXISTS images_name ON images (name COLLATE NOCASE);
+		CREATE INDEX IF NOT EXISTS images_label ON images (label COLLATE NOCASE);
+	'''
+
+	def __init__(self, db_path=None):
+		self.db_path = db_path or default_catalog_path
+
+		db_dir = os.path.dirname(self.db_path)
+		if db_dir and not os.path.isdir(db_dir):
+			os.makedirs(db_dir)
+
+		self.db = sqlite3.connect(self.db_path)
+		self.db.row_factory = sqlite3.Row
+		self._upgrade()
+		self.db.executescript(self.schema)
+
+	def _upgrade(self):
+		'''
+		Rebuilds an images table created before IDs were AUTOINCREMENT, so
+		the ID of a removed image is never given to a different one
+		'''
+
+		row = self.db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'images'").fetchone()
+
+		if row is None or "AUTOINCREMENT" in row["sql"].upper():
+			return
+
+		with self.db:
+			self.db.execute("DROP INDEX IF EXISTS images_name")
+			self.db.execute("DROP INDEX IF EXISTS images_label")
+			self.db.execute("ALTER TABLE images RENAME TO images_old")
+			self.db.executescript(self.schema)
+			self.db.execute("INSERT INTO images SELECT * FROM images_old")
+			self.db.execute("DROP TABLE images_old")
+
+	def close(self):
+		self.db.close()
+
+	def add_directory(self, path):
+		''' Adds a directory to the set of directories scanned for images '''
+
+		path = os.path.abspath(path)
+
+		if not os.path.isdir(path):
+			raise FileNotFoundError(path + " is not a directory.")
+
+		with self.db:
+			self.db.execute("INSERT OR IGNORE INTO directories (path) VALUES (?)", (path,))
+
+	def remove_directory(self, path):
+		''' Removes a directory and all the images catalogued from it '''
+
+		path = os.path.abspath(path)
+
+		with self.db:
+			self.db.execute("DELETE FROM images WHERE directory = ?", (path,))
+			self.db.execute("DELETE FROM directories WHERE path = ?", (path,))
+
+	def directories(self):
+		''' Returns a list of the configured directories '''
+
+		return [row["path"] for row in self.db.execute("SELECT path FROM directories ORDER BY path")]
+
+	def _walk_images(self, directory, failed):
+		'''
+		Yields a DirEntry for every image file below directory, appending
+		any directories that can't be read to failed
+		'''
+
+		pending = [directory]
+
+		while pending:
+			current = pending.pop()
+			try:
+				with os.scandir(current) as entries:
+					for entry in entries:
+						if entry.is_dir(follow_symlinks=False):
+							pending.append(entry.path)
+						elif entry.is_file() and entry.name.lower().endswith(image_extensions):
+							yield entry
+			except OSError as err:
+				print("Unable to scan " + current + " : " + str(err))
+				failed.append(current)
+
+	def scan(self, hash_files=False):
+		'''
+		Rescans all configured directories
+
+		Files whose size and mtime are unchanged keep their catalog entry
+		and are not opened. New or changed files have their headers read
+		and, if hash_files is set, their digests calculated. Entries for
+		files that have gone are removed, unless they were in a directory
+		that couldn't be read, such as a share that isn't mounted.
+
+		Returns a tuple of (added, updated, removed, unchanged) counts
+		'''
+
+		added = updated = removed = unchanged = 0
+
+		for directory in self.directories():
+			known = {}
+			for row in self.db.execute("SELECT id, path, size, mtime_ns, sha1 FROM images WHERE directory = ?", (directory,)):
+				known[row["path"]] = row
+
+			seen = set()
+			failed = []
+
+			with self.db:
+				for entry in self._walk_images(directory, failed):
+					try:
+						stat = entry.stat()
+					except OSError:
+						continue
+
+					seen.add(entry.path)
+					row = known.get(entry.path)
+
+					if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns \
+						and (row["sha1"] or not hash_files):
+						unchanged += 1
+						continue
+
+					try:
+						label, boot_type = read_image_info(entry.path)
+						sha1 = sha256 = None
+						if hash_files:
+							sha1, sha256 = get_digests(entry.path)
+					except OSError as err:
+						print("Unable to read " + entry.path + " : " + str(err))
+						continue
+
+					self.db.execute('''
+						INSERT INTO images (path, directory, name, size, mtime_ns, sha1, sha256, label, boot_type, scanned)
+						VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+						ON CONFLICT (path) DO UPDATE SET
+							size = excluded.size, mtime_ns = excluded.mtime_ns, sha1 = excluded.sha1,
+							sha256 = excluded.sha256, label = excluded.label, boot_type = excluded.boot_type,
+							scanned = excluded.scanned
+					''', (entry.path, directory, entry.name, stat.st_size, stat.st_mtime_ns,
+						sha1, sha256, label, boot_type, time.time()))
+
+					if row is None:
+						added += 1
+					else:
+						updated += 1
+
+				# Keep what was catalogued below directories we couldn't read
+				unreadable = tuple(os.path.join(path, "") for path in failed)
+
+				for path, row in known.items():
+					if path not in seen and not path.startswith(unreadable):
+						self.db.execute("DELETE FROM images WHERE id = ?", (row["id"],))
+						removed += 1
+
+		return (added, updated, removed, unchanged)
+
+	def search(self, text="", limit=100):
+		''' Returns the catalog entries whose name or volume label contain text '''
+
+		# Match text literally, % and _ are LIKE wildcards
+		escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+		pattern = "%" + escaped + "%"
+
+		return self.db.execute('''
+			SELECT * FROM images
+			WHERE name LIKE ? ESCAPE '\\' OR label LIKE ? ESCAPE '\\'
+			ORDER BY name COLLATE NOCASE
+			LIMIT ?
+		''', (pattern, pattern, limit)).fetchall()
+
+	def get(self, image_id):
+		''' Returns the catalog entry with the given ID '''
+
+		row = self.db.execute("SELECT * FROM images WHERE id = ?", (int(image_id),)).fetchone()
+
+		if row is None:
+			raise ValueError("Error : no image with catalog ID " + str(image_id) + ".")
+
+		return row
+
+	def get_sha1(self, image_id):
+		'''
+		Returns the SHA1 of a catalogued image, calculating and storing
+		the digests if they haven't been calculated yet or the file has
+		changed since they were
+		'''
+
+		row = self.get(image_id)
+		stat = os.stat(row["path"])
+
+		if row["sha1"] and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+			return row["sha1"]
+
+		label, boot_type = read_image_info(row["path"])
+		sha1, sha256 = get_digests(row["path"])
+
+		with self.db:
+			self.db.execute('''
+				UPDATE images SET size = ?, mtime_ns = ?, sha1 = ?, sha256 = ?, label = ?, boot_type = ?, scanned = ?
+				WHERE id = ?
+			''', (stat.st_size, stat.st_mtime_ns, sha1, sha256, label, boot_type, time.time(), row["id"]))
+
+		return sha1
+
+	def describe(self, row):
+		''' Returns a single line description of a catalog entry '''
+
+		description = "[" + str(row["id"]) + "] " + row["name"]
+
+		if row["label"]:
+			description += " (" + row["label"] + ")"
+
+		description += " " + "{:1.2f}".format(row["size"] / (1024 ** 3)) + " GB"
+
+		if row["boot_type"]:
+			description += " " + row["boot_type"]
+
+		return description
@@ -5,6 +5,17 @@ import argparse
 import signal
 import hashlib
 import math
+import time
+
+from sabas_mounts import mount_index, unmount, swapoff, is_exclusive
+from sabas_io import copy_image, copy_image_queued, copy_queued, get_backend, sequential_backend, cache_policy, cache_monitor
+from sabas_health import health_check
+from sabas_capture import capture_drive
+from sabas_manifest import get_manifest, verify_device, rewrite_chunks
+from sabas_format import filesystems, format_drive, bulk_format, default_parallel
+from sabas_trace import trace
+from sabas_history import throughput_history, throughput_recorder, drive_identity, image_type, format_eta
+from sabas_source import is_stream, readahead_source
 
 class sabas_core():
 	'''
@@ -24,6 +35,19 @@ class sabas_core():
 	selected_drive = None # This could just be selection
 	# Are we running just from the command line?
 	cline_flag = False
+	# Index of mounted and busy block devices
+	mounts = None
+	# Page cache budget in bytes, if set images are written without dd
+	cache_budget = None
+	# Verify the drive against the image's manifest after writing
+	verify_flag = False
+	# Only verify this many randomly chosen chunks
+	spot_check = None
+	# Throughput curves of previous jobs
+	history = None
+	# Requests kept in flight when writing and verifying without dd, and how
+	queue_depth = None
+	io_backend = "auto"
 
 	def __init__(self):
 		# Handle Ctrl-C a bit more cleanly
@@ -36,6 +60,7 @@ class sabas_core():
 		exit()
 
 
+	@trace.phase("find drives")
 	def find_drives(self):
 		'''
 			Checks /dev/disk/by-id for attached USB drives.
@@ -62,8 +87,10 @@ class sabas_core():
 			# Save the label for access next
 			div_to_GB = (2 * 1024 * 1024)
 			size = int(subprocess.check_output("cat /sys/class/block/" + str(label) + "/size", shell=True)) / div_to_GB
+			# The serial is the last part of the by-id name, before the -0:0 LUN
+			serial = drive.split('usb-')[1].split('_')[-1].split(' ')[0].rsplit('-', 1)[0]
 
-			self.drive_data.append((i, name, label, size))
+			self.drive_data.append((i, name, label, size, serial))
 
 
 	def create_drive_list(self):
@@ -111,47 +138,94 @@ class sabas_core():
 		self.set_selection(user_selection)
 
 
-	def hd_check(self):
-		'''Checks to make sure the selected drive isn't a hard-drive'''
+	def get_mount_index(self):
+		'''
+		Returns an index of mounted, swap and held block devices
+
+		Built once from /proc and /sys and shared by all checks, call
+		refresh() on it after anything is mounted or unmounted
+		'''
+
+		if self.mounts is None:
+			self.mounts = mount_index()
 
-		drive_name = self.selection.split("/")[-1]
+		return self.mounts
 
-		result = subprocess.check_output("find /dev/disk/by-id/ -lname " + "'*" + drive_name + "'", shell=True).decode("utf-8")
 
-		if "usb" not in result:
+	@trace.phase("hd check")
+	def hd_check(self, device=None):
+		'''Checks to make sure the selected drive, or device, isn't a hard-drive'''
+
+		device = device or self.selection
+
+		if not self.get_mount_index().is_usb(device):
 			raise ValueError("Error : this is not a USB drive.")
 
 
-	def mount_checks(self):
+	@trace.phase("mount checks")
+	def mount_checks(self, device=None):
 		'''
-		Checks the status of the selected drive and its mount status	
+		Checks the status of the selected drive, or device, and its mount status	
 
-		Attempts to unmount the selected drive
+		Attempts to unmount the drive
 		'''
+
+		device = device or self.selection
 			
-		print("Checking if " + self.selection + " is mounted...")
-		
-		mounted = ""
-		try:
-			mounted = subprocess.check_output("mount | grep " + self.selection, shell=True).decode("utf-8")
-		except subprocess.CalledProcessError as err:
-			print("Not mounted")
+		print("Checking if " + device + " is mounted...")
+
+		index = self.get_mount_index()
+		index.refresh()
+
+		users = index.users(device)
+
+		# Volumes built on the drive (LVM, dm-crypt, md) may be in use elsewhere, leave them to the user
+		holders = [user for user in users if user[1] == "holder"]
 
-		# Find is multiple partitions are mounted
-		partitions = [x for x in mounted.split(" ") if self.selection in x]
+		if holders:
+			for name, kind, detail in holders:
+				print(name + " is held by " + detail + ", it must be released before writing")
+			raise ValueError("Error : " + device + " is held by " + ", ".join(user[2] for user in holders) + ".")
 
-		if mounted:
+		# Only what sits directly on the drive's own partitions is released
+		partitions = index.partitions(device)
+		users = [user for user in users if user[0] in partitions]
+
+		if not users:
+			print("Not mounted")
+		else:
 			print("Attempting to unmount device")
-			for part in partitions:					
+
+		# Unmount the deepest mount points first so nested mounts come off cleanly
+		mount_points = sorted([user[2] for user in users if user[1] == "mount"], key=len, reverse=True)
+
+		for mount_point in mount_points:
+			try:
+				unmount(mount_point)
+				print("Unmounted " + mount_point)
+			except OSError as err:
+				print("Unable to unmount " + mount_point + " : " + err.strerror)
+
+		for name, kind, detail in users:
+			if kind == "swap":
 				try:
-					umount_stat = subprocess.check_output("umount " + part, shell=True)
-					print("Drive unmounted successfully")
-				except subprocess.CalledProcessError as err:
-					print("Unable to unmount the drive.")
+					swapoff(detail)
+					print("Stopped swapping to " + detail)
+				except OSError as err:
+					print("Unable to stop swapping to " + detail + " : " + err.strerror)
+
+		index.refresh()
+
+		if index.in_use(device) or not is_exclusive(device):
+			raise ValueError("Error : " + device + " is still in use.")
+
+		if users:
+			print("Drive unmounted successfully")
 
 
 	# This is a modified version of a function taken from
 	# https://stackoverflow.com/a/22058673/10354589
+	@trace.phase("checksum")
 	def get_checksum(self, filename):
 		'''	Returns the SHA1 hashsum of the file given by filename'''	
 
@@ -206,17 +280,43 @@ class sabas_core():
 		confirmation = ""
 		valid_confirmations = ["y", "Y", "n", "N"]
 
-		while confirmation not in valid_confirmations:
-			confirmation = input("Are you sure you want to continue and write " + self.iso_filename + "to " + self.selection + "? (y / n) : ")
+		# The image is coming in on stdin so the answer has to come from the terminal
+		stdin = sys.stdin
+		if self.iso_filename == "-":
+			try:
+				sys.stdin = open("/dev/tty")
+			except OSError:
+				raise ValueError("Error : there is no terminal to confirm writing stdin to " + self.selection \
+								+ ", pass the image as a file, named pipe or URL instead.")
+
+		try:
+			while confirmation not in valid_confirmations:
+				confirmation = input("Are you sure you want to continue and write " + self.iso_filename + "to " + self.selection + "? (y / n) : ")
+		finally:
+			if sys.stdin is not stdin:
+				sys.stdin.close()
+				sys.stdin = stdin
 
 		if confirmation == "y" or confirmation == "Y":
-			self.write_dd(self.iso_filename)
+			# Streams are verified against the SHA1 calculated as they arrived
+			if is_stream(self.iso_filename):
+				self.write_stream(self.iso_filename)
+				return
+
+			if self.cache_budget or self.queue_depth:
+				self.write_native(self.iso_filename)
+			else:
+				self.write_dd(self.iso_filename)
+
+			if self.verify_flag or self.spot_check:
+				self.verify_write(self.iso_filename)
 			
 		elif confirmation == "n" or confirmation == "N":
 			print("Exiting.")
 			exit()
 
 
+	@trace.phase("write")
 	def write_dd(self, filename, write_process = None):
 		'''
 		Does the actual writing, this can be called from either the command
@@ -230,25 +330,303 @@ class sabas_core():
 		if write_process:
 			status = write_process.start("sudo dd bs=4M if=" + our_filename + " of=" + self.selection + " status=progress oflag=sync")
 		else:
+			# dd doesn't report progress to us, so the job is recorded as a single point
+			recorder = throughput_recorder()
+
 			status = subprocess.check_output("sudo dd bs=4M if=" + our_filename + " of=" + self.selection \
 											+ " status=progress oflag=sync", shell=True).decode("utf-8")
 
+			recorder.finish(os.path.getsize(our_filename))
+			self.record_job(self.get_identity(), image_type(our_filename), recorder)
+
+
+	@trace.phase("write")
+	def write_native(self, filename):
+		'''
+		Writes the file to the drive without dd, keeping the page cache
+		used for the source and the drive within cache_budget if it is set
+		and queue_depth writes in flight if it is set
+
+		Command line only
+		'''
+
+		policy = cache_policy(self.cache_budget) if self.cache_budget else None
+		monitor = cache_monitor()
+
+		identity = self.get_identity()
+		job_type = image_type(filename)
+		total = os.stat(filename).st_size
+		recorder = throughput_recorder()
+
+		def show_progress(written):
+			recorder.update(written)
+			eta = self.get_history().predict_eta(identity, job_type, recorder, total)
+			print("\r" + str(written) + " bytes (" + self.convert_size(written) + ") copied, ETA " \
+				+ format_eta(eta) + "    ", end="", flush=True)
+
+		if self.queue_depth:
+			backend = get_backend(self.io_backend, self.queue_depth)
+			print("Writing with " + str(backend.depth) + " requests in flight using " + backend.name)
+			written = copy_image_queued(filename, self.selection, backend, policy=policy, monitor=monitor, progress=show_progress)
+		else:
+			written = copy_image(filename, self.selection, policy=policy, monitor=monitor, progress=show_progress)
+		recorder.finish(written)
+
+		print("\nWrote " + self.convert_size(written) + " to " + self.selection)
+		self.record_job(identity, job_type, recorder)
+
+		if policy:
+			print("Peak page cache footprint : " + self.convert_size(policy.peak) + " (budget " \
+				+ self.convert_size(self.cache_budget) + "), system page cache growth : " + self.convert_size(monitor.peak))
+
+
+	@trace.phase("write")
+	def write_stream(self, spec):
+		'''
+		Writes an image from stdin, a named pipe or a URL to the drive
+		while it is still arriving, fetching ahead of the writes and
+		hashing it on the way
+
+		Command line only
+		'''
+
+		source = readahead_source(spec)
+
+		if source.size is None:
+			print("Size of " + spec + " unknown until it has all arrived")
+
+		policy = cache_policy(self.cache_budget) if self.cache_budget else None
+		backend = get_backend(self.io_backend, self.queue_depth) if self.queue_depth else sequential_backend()
+
+		identity = self.get_identity()
+		job_type = image_type(spec)
+		recorder = throughput_recorder()
+
+		def show_progress(written):
+			recorder.update(written)
+			line = "\r" + str(written) + " bytes (" + self.convert_size(written) + ") copied, " \
+				+ self.convert_size(source.fetched) + " fetched"
+			if source.size:
+				eta = self.get_history().predict_eta(identity, job_type, recorder, source.size)
+				line += ", ETA " + format_eta(eta)
+			print(line + "    ", end="", flush=True)
+
+		def read_into(buffer, offset):
+			return source.readinto(buffer)
+
+		try:
+			written = copy_queued(read_into, self.selection, backend, policy=policy, progress=show_progress)
+		finally:
+			source.close()
+
+		recorder.finish(written)
+
+		if source.size is not None and written != source.size:
+			raise ValueError("Error : expected " + str(source.size) + " bytes from " + spec + " but received " + str(written) + ".")
+
+		print("\nWrote " + self.convert_size(written) + " to " + self.selection)
+		print("SHA1 : " + source.sha1.hexdigest())
+		print("SHA256 : " + source.sha256.hexdigest())
+
+		self.record_job(identity, job_type, recorder)
+
+		if self.verify_flag:
+			self.verify_stream(source.sha1.hexdigest(), written)
+
+
+	@trace.phase("verify")
+	def verify_stream(self, sha1, length):
+		''' Reads back what was written from a stream and compares it with the SHA1 calculated as it arrived '''
+
+		print("Verifying " + self.selection + "...")
+
+		fd = os.open(self.selection, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+			readback = hashlib.sha1()
+			offset = 0
+			while offset < length:
+				data = os.pread(fd, min(4 * 1024 * 1024, length - offset), offset)
+				if not data:
+					break
+				readback.update(data)
+				offset += len(data)
+		finally:
+			os.close(fd)
+
+		if readback.hexdigest() != sha1:
+			raise ValueError("Error : " + self.selection + " doesn't match the image that was written.")
+
+		print("Verified")
+
+
+	def get_history(self):
+		''' Returns the store of previous jobs' throughput '''
+
+		if self.history is None:
+			self.history = throughput_history()
+
+		return self.history
+
+
+	def get_identity(self, device=None):
+		''' Returns the (vendor, model, serial) of the selected drive, or device '''
+
+		device = device or self.selection
+
+		serial = ""
+		for drive in self.drive_data:
+			if "/dev/" + drive[2] == device:
+				serial = drive[4]
+
+		return drive_identity(device, serial)
+
+
+	def record_job(self, identity, job_type, recorder):
+		'''
+		Saves a finished job's throughput curve and warns if the drive
+		was far slower than others of the same model
+		'''
+
+		history = self.get_history()
+
+		if history.is_slow(identity, job_type, recorder.throughput()):
+			print("Warning - this drive wrote at " + self.convert_size(recorder.throughput()) + "/s, far slower than " \
+				+ "other " + " ".join(identity[:2]) + " drives (" + self.convert_size(history.model_throughput(identity, job_type)) \
+				+ "/s). It may be failing.")
+
+		history.record(identity, job_type, recorder)
+
+
+	@trace.phase("manifest")
+	def create_manifest(self, filename):
+		''' Creates the chunk manifest next to the image and shows its digests '''
+
+		print("Hashing " + filename + "...")
+
+		manifest = get_manifest(filename)
+
+		print("Chunks : " + str(len(manifest["chunks"])) + " of " + self.convert_size(manifest["chunk_size"]))
+		print("Root : " + manifest["root"])
+		print("SHA1 : " + manifest["sha1"])
+
+		return manifest
+
+
+	@trace.phase("verify")
+	def verify_write(self, filename):
+		'''
+		Reads the drive back and compares it with the image's manifest,
+		rewriting any chunks that don't match
+
+		Only spot_check randomly chosen chunks are compared if it is set
+		'''
+
+		manifest = get_manifest(filename)
+
+		print("Verifying " + self.selection + "...")
+		backend = get_backend(self.io_backend, self.queue_depth) if self.queue_depth else None
+		mismatched = verify_device(self.selection, manifest, self.spot_check, backend=backend)
 
-	def create_storage_drive(self, filesystem, write_process=None):
+		if mismatched:
+			print(str(len(mismatched)) + " chunks don't match, rewriting them...")
+			rewrite_chunks(filename, self.selection, manifest, mismatched)
 
-		# Set the partition types we want to use with different filesystems
+			still_mismatched = verify_device(self.selection, manifest, indexes=mismatched)
 
-		partition_type = None
-		format_flag = " "
-		if filesystem == "fat32":
-			partition_type = "83"
-		elif filesystem == "ntfs":
-			partition_type = "07"
-			# For fast format of the NTFS partition
-			format_flag = " -f"
-		elif filesystem == "exfat":
-			partition_type = "07"
+			if still_mismatched:
+				raise ValueError("Error : chunks " + ", ".join(str(index) for index in still_mismatched) \
+								+ " of " + self.selection + " can't be written correctly.")
+
+		if self.spot_check:
+			print("Spot check of " + str(min(self.spot_check, len(manifest["chunks"]))) + " chunks passed")
 		else:
+			print("Verified")
+
+
+	def check_health(self, exhaustive=False):
+		'''
+		Checks the selected drive really has the capacity it reports by
+		writing tagged samples across it and reading them back
+
+		Command line only
+		'''
+
+		self.hd_check()
+		self.mount_checks()
+
+		print("Warning - the health check overwrites data on " + self.selection + ".")
+
+		confirmation = ""
+		valid_confirmations = ["y", "Y", "n", "N"]
+
+		while confirmation not in valid_confirmations:
+			confirmation = input("Are you sure you want to continue and check " + self.selection + "? (y / n) : ")
+
+		if confirmation == "n" or confirmation == "N":
+			print("Exiting.")
+			exit()
+
+		def show_progress(done, total):
+			print("\rChecking... " + str(int(100 * done / total)) + "%", end="", flush=True)
+
+		with trace.span("health check", device=self.selection):
+			report = health_check(self.selection, exhaustive=exhaustive, progress=show_progress)
+
+		print("\nReported capacity : " + self.convert_size(report.capacity))
+
+		for i, region in enumerate(report.regions()):
+			if region:
+				print("Region " + str(i) + " : write " + self.convert_size(region[0]) + "/s, read " \
+					+ self.convert_size(region[1]) + "/s")
+
+		failures = report.failures()
+
+		for offset, status, detail, write_speed, read_speed in failures:
+			print("Offset " + str(offset) + " " + status + " : " + detail)
+
+		if report.wraps_around():
+			print("This drive wraps around, it is probably counterfeit.")
+
+		if failures:
+			print("Usable capacity is about " + self.convert_size(report.usable_capacity()))
+		else:
+			print("All " + str(len(report.samples)) + " samples read back correctly")
+
+		return report
+
+
+	def capture(self, output, trim=False, threads=None):
+		'''
+		Captures the selected drive to an image file, compressed if the
+		filename ends in .xz or .zst, otherwise as a sparse raw image
+
+		Command line only
+		'''
+
+		self.hd_check()
+
+		def show_progress(done, total):
+			print("\r" + self.convert_size(done) + " of " + self.convert_size(total) + " read", end="", flush=True)
+
+		with trace.span("capture", device=self.selection) as capture_span:
+			read, stored = capture_drive(self.selection, output, trim=trim, threads=threads,
+										cache_budget=self.cache_budget, progress=show_progress)
+			capture_span.set(bytes=read, stored=stored)
+
+		print("\nCaptured " + self.convert_size(read) + " from " + self.selection + " to " + output \
+			+ " using " + self.convert_size(stored))
+
+
+	def create_storage_drive(self, filesystem):
+		'''
+		Wipes the selected drive and creates a single partition formatted
+		with filesystem so it can be used for storage again
+
+		Command line only
+		'''
+
+		if filesystem not in filesystems:
 			raise ValueError("Error : incorrect filesystem selected.")
 
 		# Check that we're not trying to destroy a HD
@@ -266,45 +644,130 @@ class sabas_core():
 			confirmation = input("Are you sure you want to continue and write a " + filesystem + " partition to " + self.selection + "? (y / n) : ")
 
 		if confirmation == "y" or confirmation == "Y":
-			if write_process:
-				try:
-					# Wipes all file systems from the drive
-					write_process.start("sudo wipefs -a " + self.selection)
-					# Creates a partition
-					write_process.start("sudo echo \"type=" + partition_type + "\" | sudo sfdisk " + self.selection)
-					# Formats the partition
-					write_process.start("sudo mkfs." + filesystem + format_flag + self.selection + "1")
-				except:
-					print("Error writing to drive.")
-					exit()
-			
-			# If we're running this from the command line and don't have a QProcess			
-			else:
-				try:					
-					# Wipes all file systems from the drive
-					print("Wiping drive...")
-					status = subprocess.check_output("sudo wipefs --all " + self.selection, shell=True).decode("utf-8")
-					# Creates a partition
-					print("Creating partition...")
-					status = subprocess.check_output("sudo echo \"type=" + partition_type + "\" | sudo sfdisk " + self.selection, shell=True).decode("utf-8")
-					# Formats the partition
-					print("Formatting partition...")
-					status = subprocess.check_output("sudo mkfs." + filesystem + format_flag + self.selection + "1", shell=True).decode("utf-8")
-					print("Finished")
-				except subprocess.CalledProcessError:
-					print("Error writing to drive.")
-					exit()
-		
+			print("Wiping, partitioning and formatting drive...")
+			try:
+				with trace.span("format", device=self.selection):
+					format_drive(self.selection, filesystem)
+				print("Finished")
+			except (subprocess.CalledProcessError, OSError):
+				print("Error writing to drive.")
+				exit()
 
 		elif confirmation == "n" or confirmation == "N":
 			print("Exiting.")
 			exit()
-			
 
-		
 
-		
+	def find_storage_targets(self, targets):
+		'''
+		Returns the device paths for a comma separated list of device
+		paths and drive serials, or "all" for every USB drive found
+		'''
+
+		self.find_drives()
+
+		if targets == "all":
+			return ["/dev/" + drive[2] for drive in self.drive_data]
+
+		devices = []
+		for target in targets.split(","):
+			target = target.strip()
+
+			if target.startswith("/dev/"):
+				devices.append(target)
+				continue
+
+			matches = ["/dev/" + drive[2] for drive in self.drive_data if drive[4] == target]
+			if not matches:
+				raise ValueError("Error : no USB drive with serial " + target + " found.")
+			devices.extend(matches)
+
+		return devices
+
+
+	def create_storage_drives(self, targets, filesystem, max_parallel=default_parallel):
+		'''
+		Returns many drives to storage use at once, confirmation is asked
+		for once and then the drives are wiped, partitioned and formatted
+		concurrently, max_parallel at a time
+
+		Command line only
+		'''
+
+		if filesystem not in filesystems:
+			raise ValueError("Error : incorrect filesystem selected.")
+
+		# Start the drives expected to be slowest first so they don't hold up the end
+		targets = self.find_storage_targets(targets)
+		targets = [drive[0] for drive in self.get_history().order_slowest_first(
+					[(device, self.get_identity(device)) for device in targets])]
+
+		devices = []
+		for device in targets:
+			try:
+				self.hd_check(device)
+				devices.append(device)
+			except ValueError as err:
+				print(device + " skipped : " + str(err))
+
+		if not devices:
+			print("No drives to format.")
+			exit()
+
+		# Only say what is using the drives for now, nothing is unmounted until the user confirms
+		index = self.get_mount_index()
+		index.refresh()
 
+		uses = {"mount": " is mounted at ", "swap": " is in use as swap ", "holder": " is held by "}
+
+		for device in devices:
+			for name, kind, detail in index.users(device):
+				print(name + uses[kind] + detail)
+
+		print("Warning - this will unmount and wipe everything from " + ", ".join(devices) + " and create " \
+			+ filesystem + " filesystems.")
+
+		confirmation = ""
+		valid_confirmations = ["y", "Y", "n", "N"]
+
+		while confirmation not in valid_confirmations:
+			confirmation = input("Are you sure you want to continue and format " + str(len(devices)) + " drives? (y / n) : ")
+
+		if confirmation == "n" or confirmation == "N":
+			print("Exiting.")
+			exit()
+
+		ready = []
+		for device in devices:
+			try:
+				self.mount_checks(device)
+				ready.append(device)
+			except ValueError as err:
+				print(device + " skipped : " + str(err))
+
+		if not ready:
+			print("No drives to format.")
+			exit()
+
+		devices = ready
+
+		def show_result(device, timings, error):
+			steps = ", ".join(step + " " + "{:1.1f}".format(seconds) + " s" for step, seconds in timings)
+
+			if error:
+				print(device + " " + error + (" (after " + steps + ")" if timings else ""))
+			else:
+				print(device + " finished in " + "{:1.1f}".format(sum(t[1] for t in timings)) + " s (" + steps + ")")
+
+		start = time.monotonic()
+		with trace.span("bulk format", drives=len(devices)):
+			results = bulk_format(devices, filesystem, max_parallel, show_result)
+
+		failed = [device for device, result in results.items() if result[1]]
+		print("Formatted " + str(len(devices) - len(failed)) + " of " + str(len(devices)) + " drives in " \
+			+ "{:1.1f}".format(time.monotonic() - start) + " s")
+
+		return results
 
 
 	def run(self):
@@ -313,10 +776,11 @@ class sabas_core():
 		if self.cline_flag == False:
 			self.drive_selection()
 
-		self.mount_checks()
-
+		# Make sure it is a USB drive before anything on it is touched
 		self.hd_check()
 
+		self.mount_checks()
+
 		self.write_cline()
 
 		exit()
\ No newline at end of file
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import subprocess
+import concurrent.futures
+
+from sabas_trace import trace
+
+
+# Partition type and mkfs command for each filesystem we can create
+filesystems = {
+	"fat32": ("c", ["mkfs.vfat", "-F", "32"]),
+	"ntfs": ("7", ["mkfs.ntfs", "-f"]),
+	"exfat": ("7", ["mkfs.exfat"]),
+}
+
+# How long to wait for the kernel to create the new partition's device node
+partition_timeout = 10
+
+# Default number of drives formatted at once
+default_parallel = 4
+
+# The steps of formatting a drive, in order
+steps = ("wipe", "partition", "format")
+
+
+def partition_path(device, number=1):
+	''' Returns the path of a partition, /dev/sdb -> /dev/sdb1, /dev/mmcblk0 -> /dev/mmcblk0p1 '''
+
+	if device[-1].isdigit():
+		return device + "p" + str(number)
+
+	return device + str(number)
+
+
+def run_step(command, input_text=None):
+	''' Runs a single step of the pipeline, raising CalledProcessError with its output if it fails '''
+
+	return subprocess.run(command, input=input_text, check=True, stdout=subprocess.PIPE,
+						stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def wait_for_partition(partition, timeout=partition_timeout):
+	''' Waits for udev to create the device node of a new partition '''
+
+	if shutil.which("udevadm"):
+		subprocess.run(["udevadm", "settle", "--timeout=" + str(timeout)], stdout=subprocess.DEVNULL,
+						stderr=subprocess.DEVNULL)
+
+	deadline = time.monotonic() + timeout
+	while not os.path.exists(partition):
+		if time.monotonic() > deadline:
+			raise OSError("Timed out waiting for " + partition + " to appear")
+		time.sleep(0.1)
+
+
+def format_drive(device, filesystem, timings=None):
+	'''
+	Wipes the drive, creates a single partition and formats it with
+	filesystem, each step waits for the one before it to finish
+
+	Each finished step is appended to timings as it completes, so if
+	a step fails timings holds the steps before it
+
+	Returns the list of (step, seconds) tuples
+	'''
+
+	if filesystem not in filesystems:
+		raise ValueError("Error : incorrect filesystem selected.")
+
+	partition_type, mkfs = filesystems[filesystem]
+	partition = partition_path(device)
+	timings = [] if timings is None else timings
+
+	start = time.monotonic()
+	with trace.span("wipe", device=device):
+		run_step(["wipefs", "--all", device])
+	timings.append(("wipe", time.monotonic() - start))
+
+	start = time.monotonic()
+	with trace.span("partition", device=device):
+		run_step(["sfdisk", device], "type=" + partition_type + "\n")
+		wait_for_partition(partition)
+	timings.append(("partition", time.monotonic() - start))
+
+	start = time.monotonic()
+	with trace.span("format", device=device):
+		run_step(mkfs + [partition])
+	timings.append(("format", time.monotonic() - start))
+
+	return timings
+
+
+def bulk_format(devices, filesystem, max_parallel=default_parallel, progress=None):
+	'''
+	Formats many drives at once, at most max_parallel at a time
+
+	Arguments:
+
+	progress -- called with (device, timings, error) as each drive finishes
+
+	Returns a dictionary of device -> (timings, error), error is None
+	for drives that were formatted successfully. The timings of a
+	failed drive are those of the steps before the one that failed.
+	'''
+
+	results = {}
+
+	def format_one(device):
+		timings = []
+		try:
+			format_drive(device, filesystem, timings)
+			return (timings, None)
+		except subprocess.CalledProcessError as err:
+			error = " ".join(err.cmd) + " : " + (err.output or "").strip()
+		except OSError as err:
+			error = str(err)
+
+		return (timings, steps[len(timings)] + " step failed, " + error)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+		futures = {executor.submit(format_one, device): device for device in devices}
+
+		for future in concurrent.futures.as_completed(futures):
+			device = futures[future]
+			results[device] = future.result()
+
+			if progress:
+				progress(device, results[device][0], results[device][1])
+
+	return results
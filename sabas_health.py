@@ -0,0 +1,365 @@
+import os
+import math
+import mmap
+import time
+import errno
+import random
+import struct
+import hashlib
+
+from sabas_io import get_size
+from sabas_trace import trace
+
+
+# Size of each sample written to and read back from the drive
+default_sample_size = 1024 * 1024
+
+# Number of samples between each halving of the offset
+samples_per_octave = 4
+
+# Size of the small probes written to catch wraparound between the samples
+probe_size = 4096
+
+# Marks the start of every sample so it can be recognised when read back
+sample_magic = b"SABASHC1"
+header_format = "<8s8sQQ"
+header_size = struct.calcsize(header_format)
+
+
+class device_file():
+	'''
+	The drive or file being checked
+
+	Writes and reads go through O_DIRECT where the filesystem supports
+	it so the page cache can't hide what the drive really stored. Where
+	it doesn't each write is synced and dropped from the cache instead.
+
+	Anything with the same methods can be passed to health_check, which
+	allows drives that wrap around to be simulated.
+	'''
+
+	def __init__(self, path, capacity=None):
+		self.path = path
+		self.direct = True
+
+		try:
+			self.fd = os.open(path, os.O_RDWR | os.O_DIRECT | os.O_SYNC)
+		except OSError as err:
+			if err.errno != errno.EINVAL:
+				raise
+			self.fd = os.open(path, os.O_RDWR)
+			self.direct = False
+
+		self.capacity = capacity if capacity is not None else get_size(self.fd)
+
+	def _io(self, function, *args):
+		try:
+			return function(*args)
+		except OSError as err:
+			# Some filesystems accept O_DIRECT at open but not for the I/O
+			if err.errno != errno.EINVAL or not self.direct:
+				raise
+			os.close(self.fd)
+			self.fd = os.open(self.path, os.O_RDWR)
+			self.direct = False
+			return function(*((self.fd,) + args[1:]))
+
+	def pwrite(self, buffer, offset):
+		written = self._io(os.pwrite, self.fd, buffer, offset)
+
+		if not self.direct:
+			os.fdatasync(self.fd)
+			os.posix_fadvise(self.fd, offset, len(buffer), os.POSIX_FADV_DONTNEED)
+
+		return written
+
+	def pread_into(self, buffer, offset):
+		if not self.direct:
+			os.posix_fadvise(self.fd, offset, len(buffer), os.POSIX_FADV_DONTNEED)
+
+		return self._io(os.preadv, self.fd, [buffer], offset)
+
+	def close(self):
+		os.close(self.fd)
+
+
+def sample_offsets(capacity, sample_size=default_sample_size, exhaustive=False):
+	'''
+	Returns the offsets of the samples used to measure speed and find
+	dead regions, highest first
+
+	Samples are spread logarithmically, several per halving of the
+	capacity, so there are more near the start of the drive where real
+	flash ends on fake drives. The first and last blocks are always
+	included. The exhaustive mode checks every block.
+	'''
+
+	last = (capacity // sample_size - 1) * sample_size
+
+	if last < 0:
+		raise ValueError("Error : the drive is smaller than a single sample.")
+
+	if exhaustive:
+		return list(range(last, -1, -sample_size))
+
+	offsets = {0, last}
+	step = 0
+	while True:
+		offset = int(capacity * 2 ** (-step / samples_per_octave)) // sample_size * sample_size
+		if offset < sample_size:
+			break
+		offsets.add(min(offset, last))
+		step += 1
+
+	return sorted(offsets, reverse=True)
+
+
+def difference_cover(blocks):
+	'''
+	Returns a set of block numbers below blocks where the differences
+	between pairs include every value from blocks // 2 to blocks - 1
+
+	It is a run of about sqrt(blocks / 2) blocks at the start and the
+	same number spaced that far apart in the upper half.
+	'''
+
+	low = blocks // 2
+
+	if blocks <= 4:
+		return set(range(blocks))
+
+	step = math.isqrt(blocks - low - 1) + 1
+	cover = set(range(step))
+
+	top = low + step - 1
+	while top < blocks - 1:
+		cover.add(top)
+		top += step
+	cover.add(blocks - 1)
+
+	return cover
+
+
+def alias_probes(capacity, sample_size=default_sample_size):
+	'''
+	Returns (offsets, checkpoints) for the probes that catch a drive
+	wrapping around at any whole number of samples
+
+	A drive which wraps at real bytes stores offset at offset % real, so
+	two probes whose distance apart is a multiple of real land on the
+	same flash and the one written first reads back the other. Every
+	real below a checkpoint has a multiple between half the checkpoint
+	and the checkpoint, and the probes below each checkpoint include a
+	pair that far apart. So if every sample and probe below a checkpoint
+	reads back correctly the drive really has at least that much.
+
+	Checkpoints are the powers of two blocks and the capacity.
+	'''
+
+	blocks = capacity // sample_size
+	probes = set()
+	checkpoints = []
+
+	size = 1
+	while size < blocks:
+		probes |= difference_cover(size)
+		checkpoints.append(size * sample_size)
+		size *= 2
+
+	probes |= difference_cover(blocks)
+	checkpoints.append(capacity)
+
+	return (sorted((block * sample_size for block in probes), reverse=True), checkpoints)
+
+
+def sample_data(nonce, offset, sample_size):
+	''' Returns the unique, position tagged, pattern for the sample at offset '''
+
+	seed = hashlib.sha256(nonce + struct.pack("<Q", offset)).digest()
+	body = random.Random(seed).randbytes(sample_size - header_size)
+	digest = hashlib.sha256(body).digest()[:8]
+
+	return struct.pack(header_format, sample_magic, nonce, offset, int.from_bytes(digest, "little")) + body
+
+
+class health_report():
+	''' The results of a health check '''
+
+	def __init__(self, capacity, sample_size, checkpoints):
+		self.capacity = capacity
+		self.sample_size = sample_size
+		# Offsets below which every sample reading back correctly rules out wraparound
+		self.checkpoints = checkpoints
+		# Tuples of (offset, status, detail, write bytes/s, read bytes/s), speeds are None for probes
+		self.samples = []
+
+	def failures(self):
+		return [sample for sample in self.samples if sample[1] != "ok"]
+
+	def usable_capacity(self):
+		'''
+		The capacity the drive has been shown to really have, the highest
+		checkpoint at or below the first failing sample
+		'''
+
+		failed = [sample[0] for sample in self.failures()]
+		if not failed:
+			return self.capacity
+
+		first_failure = min(failed)
+		proven = [checkpoint for checkpoint in self.checkpoints if checkpoint <= first_failure]
+
+		return max(proven) if proven else 0
+
+	def wraps_around(self):
+		return any(sample[1] == "wrapped" for sample in self.samples)
+
+	def regions(self, count=8):
+		'''
+		Returns the average write and read speed in bytes per second for
+		count equally sized regions of the drive, None where no sample fell
+		'''
+
+		regions = []
+		region_size = self.capacity / count
+
+		for i in range(count):
+			speeds = [(sample[3], sample[4]) for sample in self.samples
+						if i * region_size <= sample[0] < (i + 1) * region_size and sample[1] == "ok"
+						and sample[3] is not None]
+			if speeds:
+				regions.append((sum(s[0] for s in speeds) / len(speeds), sum(s[1] for s in speeds) / len(speeds)))
+			else:
+				regions.append(None)
+
+		return regions
+
+
+def check_sample(buffer, nonce, offset, sample_size):
+	''' Works out what happened to the sample written at offset from what was read back '''
+
+	magic, read_nonce, read_offset, digest = struct.unpack_from(header_format, buffer)
+
+	if magic != sample_magic:
+		if buffer.count(0) == sample_size or buffer.count(0xff) == sample_size:
+			return ("dead", "reads back blank")
+		return ("dead", "reads back unknown data")
+
+	if read_nonce != nonce:
+		return ("dead", "write was lost, data from an earlier check")
+
+	if read_offset != offset:
+		return ("wrapped", "reads back the sample written at " + str(read_offset))
+
+	if hashlib.sha256(buffer[header_size:]).digest()[:8] != digest.to_bytes(8, "little"):
+		return ("corrupt", "sample data was corrupted")
+
+	return ("ok", "")
+
+
+def health_check(target, capacity=None, sample_size=default_sample_size, exhaustive=False, progress=None):
+	'''
+	Checks that a drive really has the capacity it reports
+
+	Unique patterns tagged with their position are written to sampled
+	offsets across the reported capacity, along with small probes placed
+	so that a drive which wraps around anywhere overwrites one of them.
+	Everything is written before anything is read back, bypassing the
+	page cache. Samples that read back another sample show the drive
+	wraps around, blank or unknown data shows dead or missing flash.
+	Write and read speeds are recorded for each sample.
+
+	This destroys the data at the sampled offsets.
+
+	Arguments:
+
+	target     -- a path to a drive or file, or a device_file like object
+	capacity   -- overrides the size reported by the drive
+	exhaustive -- check every block of the drive instead of a sample
+	progress   -- called with (samples done, total samples)
+
+	Returns a health_report
+	'''
+
+	device = device_file(target, capacity) if isinstance(target, str) else target
+
+	try:
+		capacity = capacity if capacity is not None else device.capacity
+		offsets = sample_offsets(capacity, sample_size, exhaustive)
+
+		if exhaustive:
+			probes, checkpoints = ([], offsets + [capacity])
+		else:
+			probes, checkpoints = alias_probes(capacity, sample_size)
+
+		# Tuples of (offset, size, is a probe), highest first
+		sampled = set(offsets)
+		writes = [(offset, sample_size, False) for offset in offsets]
+		writes += [(offset, min(probe_size, sample_size), True) for offset in probes if offset not in sampled]
+		writes.sort(reverse=True)
+
+		report = health_report(capacity, sample_size, checkpoints)
+		nonce = os.urandom(8)
+		write_speeds = {}
+		write_errors = {}
+
+		# O_DIRECT needs page aligned buffers, which mmap gives us
+		buffer = mmap.mmap(-1, sample_size)
+
+		for i, (offset, size, is_probe) in enumerate(writes):
+			view = memoryview(buffer)[:size]
+			view[:] = sample_data(nonce, offset, size)
+
+			start = time.perf_counter()
+			try:
+				with trace.span("health write", offset=offset, bytes=size):
+					device.pwrite(view, offset)
+			except OSError as err:
+				write_errors[offset] = "write failed : " + os.strerror(err.errno)
+			write_speeds[offset] = size / max(time.perf_counter() - start, 1e-9)
+
+			view.release()
+
+			if progress:
+				progress(i + 1, 2 * len(writes))
+
+		for i, (offset, size, is_probe) in enumerate(writes):
+			view = memoryview(buffer)[:size]
+
+			start = time.perf_counter()
+			try:
+				with trace.span("health read", offset=offset, bytes=size):
+					count = device.pread_into(view, offset)
+			except OSError as err:
+				count = None
+				read_error = "read failed : " + os.strerror(err.errno)
+			read_speed = size / max(time.perf_counter() - start, 1e-9)
+
+			if offset in write_errors:
+				status, detail = ("dead", write_errors[offset])
+			elif count is None:
+				status, detail = ("dead", read_error)
+			elif count < size:
+				status, detail = ("dead", "short read of " + str(count) + " bytes")
+			else:
+				status, detail = check_sample(bytes(view), nonce, offset, size)
+
+			view.release()
+
+			if is_probe:
+				report.samples.append((offset, status, detail, None, None))
+			else:
+				report.samples.append((offset, status, detail, write_speeds[offset], read_speed))
+
+			if progress:
+				progress(len(writes) + i + 1, 2 * len(writes))
+
+		buffer.close()
+
+	finally:
+		if isinstance(target, str):
+			device.close()
+
+	report.samples.sort()
+
+	return report
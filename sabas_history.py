@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import sqlite3
+import statistics
+
+
+# Where the history database lives unless another path is given
+default_history_path = os.path.join(os.path.expanduser("~"), ".sabas", "history.db")
+
+# Number of points kept from each job's throughput curve
+curve_points = 64
+
+# Jobs kept for each drive model and image type, and in total
+max_jobs_per_model = 50
+max_jobs = 5000
+
+# A drive slower than this fraction of its model's median is flagged
+slow_factor = 0.5
+
+# Fewest jobs of a model before it is compared with its history
+min_jobs_to_compare = 3
+
+
+def drive_identity(device, serial="", sys_root="/sys"):
+	''' Returns (vendor, model, serial) for a block device, read from sysfs '''
+
+	name = os.path.basename(device)
+	identity = []
+
+	for attribute in ("vendor", "model"):
+		try:
+			with open(os.path.join(sys_root, "block", name, "device", attribute)) as f:
+				identity.append(f.read().strip())
+		except OSError:
+			identity.append("")
+
+	return (identity[0], identity[1], serial)
+
+
+def image_type(filename):
+	''' The type of image used to key the history, its extension '''
+
+	return os.path.splitext(filename)[1].lower().lstrip(".") or "raw"
+
+
+class throughput_recorder():
+	'''
+	Records how many bytes had been written at each point in time
+	during a single job
+	'''
+
+	# Seconds between recorded samples
+	interval = 0.25
+
+	def __init__(self):
+		self.start = time.monotonic()
+		self.samples = [(0, 0.0)]
+
+	def update(self, bytes_done):
+		elapsed = time.monotonic() - self.start
+
+		if bytes_done > self.samples[-1][0] and elapsed - self.samples[-1][1] >= self.interval:
+			self.samples.append((bytes_done, elapsed))
+
+	def finish(self, bytes_done):
+		''' Records the final sample, however soon after the last one it is '''
+
+		elapsed = time.monotonic() - self.start
+		if bytes_done >= self.samples[-1][0] and elapsed > self.samples[-1][1]:
+			self.samples.append((bytes_done, elapsed))
+
+	def elapsed(self):
+		return time.monotonic() - self.start
+
+	def bytes_done(self):
+		return self.samples[-1][0]
+
+	def throughput(self):
+		''' The average throughput of the job so far in bytes per second '''
+
+		bytes_done, elapsed = self.samples[-1]
+		return bytes_done / elapsed if elapsed > 0 else 0
+
+	def curve(self, points=curve_points):
+		''' Returns the samples thinned to at most points, evenly spaced in bytes '''
+
+		if len(self.samples) <= points:
+			return list(self.samples)
+
+		total = self.samples[-1][0]
+		curve = [self.samples[0]]
+		next_mark = total / (points - 1)
+
+		for sample in self.samples[1:-1]:
+			if sample[0] >= next_mark:
+				curve.append(sample)
+				next_mark = sample[0] + total / (points - 1)
+
+		curve.append(self.samples[-1])
+		return curve
+
+
+def time_at(curve, bytes_done):
+	'''
+	Returns the time a job with the given curve took to write bytes_done,
+	extrapolating from the rate over the last quarter of the curve for
+	jobs that wrote less than bytes_done
+	'''
+
+	for i in range(1, len(curve)):
+		if curve[i][0] >= bytes_done:
+			b0, t0 = curve[i - 1]
+			b1, t1 = curve[i]
+			return t0 + (t1 - t0) * (bytes_done - b0) / (b1 - b0) if b1 > b0 else t1
+
+	end_bytes, end_time = curve[-1]
+	tail = [sample for sample in curve if sample[0] >= 0.75 * end_bytes]
+	tail_bytes = end_bytes - tail[0][0]
+	tail_time = end_time - tail[0][1]
+
+	if tail_bytes <= 0 or tail_time <= 0:
+		return end_time * bytes_done / end_bytes if end_bytes else 0
+
+	return end_time + (bytes_done - end_bytes) * tail_time / tail_bytes
+
+
+class throughput_history():
+	'''
+	A local store of the throughput curves of completed jobs, keyed by
+	drive vendor, model and serial and by image type, used to predict
+	how long a write will take and to spot drives that are failing
+	'''
+
+	schema = '''
+		CREATE TABLE IF NOT EXISTS jobs (
+			id INTEGER PRIMARY KEY,
+			vendor TEXT NOT NULL,
+			model TEXT NOT NULL,
+			serial TEXT NOT NULL,
+			image_type TEXT NOT NULL,
+			bytes INTEGER NOT NULL,
+			seconds REAL NOT NULL,
+			curve TEXT NOT NULL,
+			finished REAL NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS jobs_model ON jobs (vendor, model, image_type);
+	'''
+
+	def __init__(self, db_path=None):
+		self.db_path = db_path or default_history_path
+
+		db_dir = os.path.dirname(self.db_path)
+		if db_dir and not os.path.isdir(db_dir):
+			os.makedirs(db_dir)
+
+		self.db = sqlite3.connect(self.db_path)
+		self.db.executescript(self.schema)
+
+	def close(self):
+		self.db.close()
+
+	def record(self, identity, job_type, recorder):
+		''' Saves a completed job, dropping the oldest jobs beyond the retention limits '''
+
+		vendor, model, serial = identity
+		bytes_done, seconds = recorder.samples[-1]
+
+		if bytes_done <= 0 or seconds <= 0:
+			return
+
+		with self.db:
+			self.db.execute('''
+				INSERT INTO jobs (vendor, model, serial, image_type, bytes, seconds, curve, finished)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+			''', (vendor, model, serial, job_type, bytes_done, seconds, json.dumps(recorder.curve()), time.time()))
+
+			self.db.execute('''
+				DELETE FROM jobs WHERE vendor = ? AND model = ? AND image_type = ? AND id NOT IN (
+					SELECT id FROM jobs WHERE vendor = ? AND model = ? AND image_type = ?
+					ORDER BY finished DESC LIMIT ?)
+			''', (vendor, model, job_type, vendor, model, job_type, max_jobs_per_model))
+
+			self.db.execute('''
+				DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY finished DESC LIMIT ?)
+			''', (max_jobs,))
+
+	def jobs(self, identity, job_type=None):
+		'''
+		Returns (serial, bytes, seconds, curve) for the jobs of the same
+		drive model, of the same image type if there are any
+		'''
+
+		vendor, model = identity[0], identity[1]
+
+		rows = []
+		if job_type:
+			rows = self.db.execute('''
+				SELECT serial, bytes, seconds, curve FROM jobs
+				WHERE vendor = ? AND model = ? AND image_type = ?
+			''', (vendor, model, job_type)).fetchall()
+
+		if not rows:
+			rows = self.db.execute('''
+				SELECT serial, bytes, seconds, curve FROM jobs WHERE vendor = ? AND model = ?
+			''', (vendor, model)).fetchall()
+
+		return [(row[0], row[1], row[2], json.loads(row[3])) for row in rows]
+
+	def predict_eta(self, identity, job_type, recorder, total):
+		'''
+		Predicts the seconds left until total bytes have been written
+
+		Each previous job of the same model gives a prediction: the time
+		it took from here to total, scaled by how fast this job has been
+		compared with it so far. This accounts for the early speed while
+		the cache fills. The median prediction is used. Without history
+		the rate over the most recent part of the job is used.
+
+		Returns None if there isn't enough to go on yet
+		'''
+
+		bytes_done = recorder.bytes_done()
+		elapsed = recorder.elapsed()
+
+		if bytes_done >= total:
+			return 0
+
+		predictions = []
+		for serial, job_bytes, seconds, curve in self.jobs(identity, job_type):
+			done_time = time_at(curve, bytes_done)
+			if done_time > 0:
+				predictions.append((elapsed / done_time) * (time_at(curve, total) - done_time))
+
+		if predictions:
+			return statistics.median(predictions)
+
+		# Ignore the first part of the job, which is usually filling the cache
+		recent = [sample for sample in recorder.samples if sample[0] >= bytes_done * 0.5]
+		if len(recent) < 2 or elapsed < 5:
+			return None
+
+		rate = (recent[-1][0] - recent[0][0]) / (recent[-1][1] - recent[0][1]) if recent[-1][1] > recent[0][1] else 0
+
+		return (total - bytes_done) / rate if rate > 0 else None
+
+	def model_throughput(self, identity, job_type=None):
+		''' The median throughput in bytes per second of the drive model, or None without enough history '''
+
+		jobs = self.jobs(identity, job_type)
+
+		if len(jobs) < min_jobs_to_compare:
+			return None
+
+		return statistics.median(job_bytes / seconds for serial, job_bytes, seconds, curve in jobs)
+
+	def is_slow(self, identity, job_type, throughput, factor=slow_factor):
+		''' Is the throughput far below the drive model's history, which suggests the drive is failing '''
+
+		expected = self.model_throughput(identity, job_type)
+
+		return expected is not None and throughput < factor * expected
+
+	def order_slowest_first(self, drives, job_type=None):
+		'''
+		Orders (device, identity) pairs so the drives expected to be
+		slowest start first, drives without history are treated as slowest
+		'''
+
+		def expected(drive):
+			device, identity = drive
+			# Prefer the history of the drive itself
+			jobs = [job for job in self.jobs(identity, job_type) if job[0] == identity[2]]
+			if jobs:
+				return statistics.median(job[1] / job[2] for job in jobs)
+			throughput = self.model_throughput(identity, job_type)
+			return throughput if throughput is not None else 0
+
+		return sorted(drives, key=expected)
+
+
+def format_eta(seconds):
+	''' Returns a short string such as 3m 20s for a number of seconds '''
+
+	if seconds is None:
+		return "estimating..."
+
+	seconds = int(round(seconds))
+	minutes, seconds = divmod(seconds, 60)
+	hours, minutes = divmod(minutes, 60)
+
+	if hours:
+		return str(hours) + "h " + str(minutes) + "m"
+	if minutes:
+		return str(minutes) + "m " + str(seconds) + "s"
+	return str(seconds) + "s"
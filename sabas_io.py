@@ -0,0 +1,605 @@
+import os
+import mmap
+import stat
+import errno
+import ctypes
+import concurrent.futures
+
+from sabas_trace import trace
+import sabas_uring
+
+
+# Default size of each read and write, matches the bs=4M used with dd
+default_block_size = 4 * 1024 * 1024
+
+# Default page cache budget for each stream
+default_cache_budget = 64 * 1024 * 1024
+
+# Default number of requests kept in flight by the queued backends
+default_queue_depth = 8
+
+# O_DIRECT transfers must start, end and sit in memory on this boundary
+direct_alignment = 4096
+
+
+def _fadvise(fd, offset, length, advice):
+	''' posix_fadvise that ignores filesystems and pipes that don't support it '''
+
+	try:
+		os.posix_fadvise(fd, offset, length, advice)
+	except OSError:
+		pass
+
+
+class cache_window():
+	'''
+	Tracks the part of a single sequentially accessed file that we have
+	left in the page cache and drops it once it is larger than the budget
+	'''
+
+	def __init__(self, fd, budget, readahead, writing):
+		self.fd = fd
+		self.budget = budget
+		self.readahead = readahead
+		self.writing = writing
+
+		# Everything before dropped has been released from the cache
+		self.dropped = 0
+		# Everything before advised has been requested with WILLNEED
+		self.advised = 0
+		self.position = 0
+
+		if not writing:
+			_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			self._advise_ahead()
+
+	def _advise_ahead(self):
+		''' Asks the kernel to read ahead of the cursor, up to readahead bytes '''
+
+		target = self.position + self.readahead
+		if target - self.advised >= self.readahead // 2:
+			start = max(self.advised, self.position)
+			_fadvise(self.fd, start, target - start, os.POSIX_FADV_WILLNEED)
+			self.advised = target
+
+	def advance(self, position):
+		''' Moves the cursor to position and releases anything over budget behind it '''
+
+		self.position = position
+
+		if not self.writing:
+			self._advise_ahead()
+
+		behind = self.position - self.dropped
+		if behind >= self.budget:
+			# Dirty pages can't be dropped, they have to be written out first
+			if self.writing:
+				os.fdatasync(self.fd)
+			_fadvise(self.fd, self.dropped, behind, os.POSIX_FADV_DONTNEED)
+			self.dropped = self.position
+
+	def finish(self):
+		''' Releases everything this stream has left in the cache '''
+
+		if self.writing:
+			os.fdatasync(self.fd)
+		_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		self.dropped = self.position
+
+	def footprint(self):
+		''' The number of bytes of this stream that may still be cached '''
+
+		return max(self.advised, self.position) - self.dropped
+
+
+class cache_policy():
+	'''
+	Keeps the page cache used by writing an image within a budget
+
+	The source is read with SEQUENTIAL and WILLNEED advice a bounded
+	distance ahead of the read cursor and DONTNEED behind it, written
+	target pages are flushed and dropped once they exceed the budget
+	'''
+
+	def __init__(self, budget=default_cache_budget, readahead=None):
+		self.budget = budget
+		self.readahead = readahead if readahead is not None else min(budget // 4, 16 * 1024 * 1024)
+		self.windows = []
+		self.peak = 0
+
+	# The budget is shared between the data behind the source cursor, the
+	# readahead in front of it and the written target pages
+
+	def open_source(self, fd):
+		window = cache_window(fd, max((self.budget - self.readahead) // 2, 1), self.readahead, False)
+		self.windows.append(window)
+		return window
+
+	def open_target(self, fd):
+		window = cache_window(fd, max(self.budget // 2, 1), 0, True)
+		self.windows.append(window)
+		return window
+
+	def update_peak(self):
+		footprint = sum(window.footprint() for window in self.windows)
+		if footprint > self.peak:
+			self.peak = footprint
+
+
+class cache_monitor():
+	'''
+	Samples the system page cache from /proc/meminfo to find the peak
+	growth in cached and dirty pages over a run
+	'''
+
+	def __init__(self, meminfo="/proc/meminfo"):
+		self.meminfo = meminfo
+		self.start = self.read()
+		self.peak = 0
+
+	def read(self):
+		''' Returns the bytes of page cache in use, including dirty pages '''
+
+		values = {}
+		try:
+			with open(self.meminfo) as f:
+				for line in f:
+					key, _, value = line.partition(":")
+					values[key] = int(value.split()[0]) * 1024
+		except (OSError, ValueError, IndexError):
+			return 0
+
+		return values.get("Cached", 0) + values.get("Buffers", 0)
+
+	def sample(self):
+		growth = self.read() - self.start
+		if growth > self.peak:
+			self.peak = growth
+
+
+def open_direct(path, flags, mode=0o644):
+	'''
+	Opens path with O_DIRECT so reads and writes go to the device rather
+	than the page cache, and each request in flight is a request at the
+	drive. Falls back to the page cache on filesystems without O_DIRECT.
+
+	Returns a tuple of (fd, direct)
+	'''
+
+	try:
+		return (os.open(path, flags | os.O_DIRECT, mode), True)
+	except OSError as err:
+		if err.errno != errno.EINVAL:
+			raise
+
+	return (os.open(path, flags, mode), False)
+
+
+def align_down(value, alignment=direct_alignment):
+	return value - value % alignment
+
+
+def align_up(value, alignment=direct_alignment):
+	return -(-value // alignment) * alignment
+
+
+def get_size(fd):
+	''' Returns the size of a regular file or block device '''
+
+	mode = os.fstat(fd).st_mode
+
+	if stat.S_ISBLK(mode):
+		return os.lseek(fd, 0, os.SEEK_END)
+
+	return os.fstat(fd).st_size
+
+
+def copy_image(source_path, target_path, block_size=default_block_size, policy=None, monitor=None, progress=None):
+	'''
+	Copies source_path to target_path, without using dd
+
+	Arguments:
+
+	policy   -- a cache_policy used to limit the page cache footprint
+	monitor  -- a cache_monitor sampled after every block
+	progress -- called with the number of bytes written after every block
+
+	Returns the number of bytes written
+	'''
+
+	source_fd = os.open(source_path, os.O_RDONLY)
+	try:
+		target_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT, 0o644)
+	except OSError:
+		os.close(source_fd)
+		raise
+
+	written = 0
+
+	try:
+		if policy:
+			source_window = policy.open_source(source_fd)
+			target_window = policy.open_target(target_fd)
+
+		while True:
+			with trace.span("read block") as read_span:
+				data = os.read(source_fd, block_size)
+				read_span.set(bytes=len(data))
+			if not data:
+				break
+
+			with trace.span("write block", bytes=len(data)):
+				view = memoryview(data)
+				while view:
+					count = os.write(target_fd, view)
+					view = view[count:]
+
+			written += len(data)
+
+			if policy:
+				source_window.advance(written)
+				target_window.advance(written)
+				policy.update_peak()
+
+			if monitor:
+				monitor.sample()
+
+			if progress:
+				progress(written)
+
+		# Don't leave the tail of a previous, larger, file behind
+		if stat.S_ISREG(os.fstat(target_fd).st_mode):
+			os.ftruncate(target_fd, written)
+
+		with trace.span("sync"):
+			if policy:
+				source_window.finish()
+				target_window.finish()
+			else:
+				os.fsync(target_fd)
+
+		if monitor:
+			monitor.sample()
+
+	finally:
+		os.close(source_fd)
+		os.close(target_fd)
+
+	return written
+
+
+class sequential_backend():
+	'''
+	Does each request as soon as it is submitted, one at a time, this
+	is what dd does and is the baseline the other backends are measured
+	against
+	'''
+
+	name = "sequential"
+
+	def __init__(self, depth=1):
+		self.depth = 1
+		self.done = []
+
+	def submit(self, writing, fd, buffer, start, length, offset, tag):
+		view = memoryview(buffer)[start:start + length]
+
+		if writing:
+			self.done.append((tag, os.pwritev(fd, [view], offset)))
+		else:
+			self.done.append((tag, os.preadv(fd, [view], offset)))
+
+	def complete(self):
+		done, self.done = self.done, []
+		return done
+
+	def close(self):
+		pass
+
+
+class thread_backend():
+	'''
+	Keeps up to depth positional reads and writes in flight on a pool of
+	threads, os.pwritev and os.preadv release the GIL while they wait
+	'''
+
+	name = "threads"
+
+	def __init__(self, depth=default_queue_depth):
+		self.depth = depth
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=depth, thread_name_prefix="sabas-io")
+		self.pending = {}
+
+	def submit(self, writing, fd, buffer, start, length, offset, tag):
+		view = memoryview(buffer)[start:start + length]
+		function = os.pwritev if writing else os.preadv
+
+		self.pending[self.executor.submit(function, fd, [view], offset)] = tag
+
+	def complete(self):
+		''' Waits for at least one request and returns (tag, bytes) for every completed request '''
+
+		if not self.pending:
+			return []
+
+		done, _ = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+		# result() raises the OSError of a failed request
+		return [(self.pending.pop(future), future.result()) for future in done]
+
+	def close(self):
+		self.executor.shutdown()
+
+
+class uring_backend():
+	'''
+	Keeps up to depth reads and writes in flight with io_uring, without
+	any extra threads. Buffers must be mmaps so their addresses don't move.
+	'''
+
+	name = "io_uring"
+
+	def __init__(self, depth=default_queue_depth):
+		self.depth = depth
+		self.ring = sabas_uring.io_uring(depth)
+		self.pending = {}
+		self.next_id = 0
+		# Holds each buffer's address while it is in use
+		self.addresses = {}
+
+	def _address(self, buffer):
+		key = id(buffer)
+		if key not in self.addresses:
+			self.addresses[key] = (buffer, ctypes.c_char.from_buffer(buffer))
+		return ctypes.addressof(self.addresses[key][1])
+
+	def submit(self, writing, fd, buffer, start, length, offset, tag):
+		opcode = sabas_uring.IORING_OP_WRITEV if writing else sabas_uring.IORING_OP_READV
+
+		self.next_id += 1
+		self.pending[self.next_id] = tag
+		self.ring.prepare(opcode, fd, self._address(buffer) + start, length, offset, self.next_id)
+
+	def complete(self):
+		''' Submits anything queued, waits for at least one completion and returns (tag, bytes) for each '''
+
+		if not self.pending:
+			return []
+
+		completed = []
+		while not completed:
+			self.ring.enter(1)
+			completed = self.ring.completions()
+
+		results = []
+		for user_data, result in completed:
+			tag = self.pending.pop(user_data)
+			if result < 0:
+				raise OSError(-result, os.strerror(-result))
+			results.append((tag, result))
+
+		return results
+
+	def close(self):
+		# Release the buffers before the ring goes
+		self.addresses.clear()
+		self.ring.close()
+
+
+backends = {
+	"sequential": sequential_backend,
+	"threads": thread_backend,
+	"io_uring": uring_backend,
+}
+
+
+def get_backend(name="auto", depth=default_queue_depth):
+	'''
+	Returns an I/O backend, auto uses io_uring where the kernel allows
+	it and a thread pool where it doesn't
+	'''
+
+	if name == "auto":
+		if depth <= 1:
+			return sequential_backend()
+		try:
+			return uring_backend(depth)
+		except OSError:
+			return thread_backend(depth)
+
+	if name not in backends:
+		raise ValueError("Error : unknown I/O backend " + name + ", options are auto, " + ", ".join(backends))
+
+	return backends[name](depth)
+
+
+def copy_image_queued(source_path, target_path, backend, block_size=default_block_size, policy=None, monitor=None, progress=None):
+	'''
+	Copies source_path to target_path keeping backend.depth writes in
+	flight at once, see copy_queued
+
+	Returns the number of bytes written
+	'''
+
+	source_fd = os.open(source_path, os.O_RDONLY)
+
+	def read_into(buffer, offset):
+		return os.preadv(source_fd, [buffer], offset)
+
+	try:
+		return copy_queued(read_into, target_path, backend, block_size, policy, monitor, progress, source_fd)
+	finally:
+		os.close(source_fd)
+
+
+def write_tail(target_path, buffer, start, offset, length):
+	''' Writes length bytes from start in buffer to offset through the page cache, for what O_DIRECT can't write '''
+
+	fd = os.open(target_path, os.O_WRONLY)
+
+	try:
+		view = memoryview(buffer)[start:start + length]
+		while view:
+			count = os.pwrite(fd, view, offset)
+			view = view[count:]
+			offset += count
+		view.release()
+
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def copy_queued(read_into, target_path, backend, block_size=default_block_size, policy=None, monitor=None, progress=None,
+				source_fd=None):
+	'''
+	Copies whatever read_into(buffer, offset) reads to target_path keeping
+	backend.depth writes in flight at once. read_into returns the number
+	of bytes it read, 0 at the end of the source.
+
+	The target is opened with O_DIRECT where possible, so each write in
+	flight is a request queued at the drive rather than a copy into the
+	page cache. An unaligned tail at the end of the image is written
+	through the page cache once everything else has completed.
+
+	Writes can complete in any order, progress only ever reports the
+	bytes up to the first write that hasn't completed, and short writes
+	are resubmitted for the rest of their block. The backend is closed
+	when the copy finishes.
+
+	The cache policy is applied to source_fd if it is given.
+
+	Returns the number of bytes written
+	'''
+
+	target_fd, direct = open_direct(target_path, os.O_WRONLY | os.O_CREAT)
+
+	# mmaps are page aligned and never move, which io_uring and O_DIRECT need
+	slots = [mmap.mmap(-1, block_size) for i in range(backend.depth)]
+	free = list(range(backend.depth))
+	# Slot -> (offset, length, bytes done) for writes in flight
+	in_flight = {}
+	# Offset -> length of completed writes beyond the contiguous point
+	finished = {}
+	contiguous = 0
+	offset = 0
+	end_of_file = False
+	# (slot, start in slot, offset, length) of the unaligned end of the image
+	tail = None
+
+	def fill(slot):
+		''' Reads a whole block into slot, so only the last block of the image is short '''
+
+		view = memoryview(slots[slot])
+		count = 0
+
+		try:
+			while count < block_size:
+				read = read_into(view[count:], offset + count)
+				if read == 0:
+					break
+				count += read
+		finally:
+			view.release()
+
+		return count
+
+	try:
+		source_window = None
+		if policy:
+			if source_fd is not None:
+				source_window = policy.open_source(source_fd)
+			target_window = policy.open_target(target_fd)
+
+		while not end_of_file or in_flight:
+			# Fill the queue
+			while free and not end_of_file:
+				slot = free.pop()
+
+				with trace.span("read block") as read_span:
+					count = fill(slot)
+					read_span.set(bytes=count)
+
+				if count < block_size:
+					end_of_file = True
+
+				length = align_down(count) if direct else count
+
+				if length < count:
+					tail = (slot, length, offset + length, count - length)
+
+				if length:
+					in_flight[slot] = (offset, length, 0)
+					backend.submit(True, target_fd, slots[slot], 0, length, offset, slot)
+				elif tail is None:
+					free.append(slot)
+
+				offset += count
+
+				if source_window:
+					source_window.advance(offset)
+
+			with trace.span("write completions") as completion_span:
+				completed = backend.complete()
+				completion_span.set(requests=len(completed))
+
+			for slot, count in completed:
+				start, length, done = in_flight[slot]
+				done += count
+
+				if count == 0:
+					raise OSError(errno.EIO, "Write to " + target_path + " made no progress at " + str(start + done))
+
+				if done < length:
+					in_flight[slot] = (start, length, done)
+					backend.submit(True, target_fd, slots[slot], done, length - done, start + done, slot)
+				else:
+					del in_flight[slot]
+					free.append(slot)
+					finished[start] = length
+
+			while contiguous in finished:
+				contiguous += finished.pop(contiguous)
+
+			if policy:
+				target_window.advance(contiguous)
+				policy.update_peak()
+
+			if monitor:
+				monitor.sample()
+
+			if progress:
+				progress(contiguous)
+
+		if tail:
+			slot, start, tail_offset, length = tail
+
+			with trace.span("write tail", bytes=length):
+				write_tail(target_path, slots[slot], start, tail_offset, length)
+
+			contiguous += length
+
+			if progress:
+				progress(contiguous)
+
+		if stat.S_ISREG(os.fstat(target_fd).st_mode):
+			os.ftruncate(target_fd, offset)
+
+		with trace.span("sync"):
+			if source_window:
+				source_window.finish()
+			if policy:
+				target_window.finish()
+			else:
+				os.fsync(target_fd)
+
+		if monitor:
+			monitor.sample()
+
+	finally:
+		backend.close()
+		for slot in slots:
+			slot.close()
+		os.close(target_fd)
+
+	return offset
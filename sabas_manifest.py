@@ -0,0 +1,309 @@
+import os
+import mmap
+import json
+import random
+import hashlib
+import threading
+import concurrent.futures
+
+from sabas_io import get_size, open_direct, align_up, direct_alignment
+from sabas_trace import trace
+
+
+# Default size of each hashed chunk
+default_chunk_size = 4 * 1024 * 1024
+
+# Added to the image filename to give the manifest's filename
+manifest_suffix = ".sabas-manifest"
+
+manifest_version = 1
+
+
+def manifest_path(image):
+	return image + manifest_suffix
+
+
+def chunk_digest(fd, index, chunk_size, size):
+	''' Returns the SHA256 of a single chunk, read with pread so chunks can be hashed from many threads '''
+
+	offset = index * chunk_size
+	length = min(chunk_size, size - offset)
+	sha256 = hashlib.sha256()
+
+	with trace.span("hash chunk", chunk=index, bytes=length):
+		# Read in pieces to keep the memory used by each thread down
+		while length > 0:
+			data = os.pread(fd, min(length, 1024 * 1024), offset)
+			if not data:
+				break
+			sha256.update(data)
+			offset += len(data)
+			length -= len(data)
+
+	return sha256.hexdigest()
+
+
+def root_digest(chunks):
+	'''
+	Returns the root of the hash tree over the chunk digests, each
+	parent is the SHA256 of its two children and an odd node at the
+	end of a level is carried up unchanged
+	'''
+
+	level = [bytes.fromhex(digest) for digest in chunks]
+
+	if not level:
+		return hashlib.sha256().hexdigest()
+
+	while len(level) > 1:
+		parents = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+		if len(level) % 2:
+			parents.append(level[-1])
+		level = parents
+
+	return level[0].hex()
+
+
+def hash_chunks(fd, size, chunk_size, indexes=None, workers=None):
+	'''
+	Hashes the chunks given by indexes, or all of them, across a pool of
+	threads, hashlib and pread both release the GIL
+
+	Returns a dictionary of chunk index -> digest
+	'''
+
+	count = -(-size // chunk_size)
+	indexes = range(count) if indexes is None else indexes
+	workers = workers or os.cpu_count() or 1
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {index: executor.submit(chunk_digest, fd, index, chunk_size, size) for index in indexes}
+
+	return {index: future.result() for index, future in futures.items()}
+
+
+def hash_chunks_queued(fd, size, chunk_size, indexes, backend):
+	'''
+	Hashes the chunks given by indexes keeping backend.depth reads in
+	flight, each chunk is hashed as soon as its read completes. The
+	backend is closed when all the chunks have been hashed.
+
+	Reads are whole multiples of direct_alignment so fd can be opened
+	with O_DIRECT, only the bytes of the image are hashed.
+
+	Returns a dictionary of chunk index -> digest
+	'''
+
+	pending = list(indexes)
+	pending.reverse()
+	slots = [mmap.mmap(-1, align_up(chunk_size)) for i in range(backend.depth)]
+	free = list(range(backend.depth))
+	# Slot -> (chunk index, length, bytes done)
+	in_flight = {}
+	digests = {}
+
+	try:
+		while pending or in_flight:
+			while free and pending:
+				index = pending.pop()
+				slot = free.pop()
+				length = min(chunk_size, size - index * chunk_size)
+
+				in_flight[slot] = (index, length, 0)
+				backend.submit(False, fd, slots[slot], 0, align_up(length), index * chunk_size, slot)
+
+			for slot, count in backend.complete():
+				index, length, done = in_flight[slot]
+				done += count
+
+				# A read past the end of the drive gives a short chunk, which can't match
+				if done < length and count > 0 and done % direct_alignment == 0:
+					in_flight[slot] = (index, length, done)
+					backend.submit(False, fd, slots[slot], done, align_up(length) - done, index * chunk_size + done, slot)
+					continue
+
+				done = min(done, length)
+				with trace.span("hash chunk", chunk=index, bytes=done):
+					digests[index] = hashlib.sha256(memoryview(slots[slot])[:done]).hexdigest()
+
+				del in_flight[slot]
+				free.append(slot)
+
+	finally:
+		backend.close()
+		for slot in slots:
+			slot.close()
+
+	return digests
+
+
+def sequential_sha1(fd, size, result):
+	''' Calculates the whole file SHA1, for comparison with publishers' checksums '''
+
+	sha1 = hashlib.sha1()
+	offset = 0
+
+	with trace.span("sha1", bytes=size):
+		while offset < size:
+			data = os.pread(fd, min(1024 * 1024, size - offset), offset)
+			if not data:
+				break
+			sha1.update(data)
+			offset += len(data)
+
+	result.append(sha1.hexdigest())
+
+
+def create_manifest(image, chunk_size=default_chunk_size, workers=None):
+	'''
+	Creates the manifest of an image: its size, the chunk size, the
+	digest of every chunk, the root of the hash tree over them and the
+	SHA1 of the whole image. The chunks are hashed in parallel while
+	the SHA1 is calculated alongside them on its own thread.
+	'''
+
+	fd = os.open(image, os.O_RDONLY)
+	sha1_thread = None
+
+	try:
+		size = get_size(fd)
+
+		sha1_result = []
+		sha1_thread = threading.Thread(target=sequential_sha1, args=(fd, size, sha1_result))
+		sha1_thread.start()
+
+		digests = hash_chunks(fd, size, chunk_size, workers=workers)
+		mtime_ns = os.fstat(fd).st_mtime_ns
+
+	finally:
+		# The SHA1 thread reads from fd, it must finish before fd is closed
+		if sha1_thread:
+			sha1_thread.join()
+		os.close(fd)
+
+	chunks = [digests[index] for index in range(len(digests))]
+
+	return {
+		"version": manifest_version,
+		"algorithm": "sha256",
+		"size": size,
+		"mtime_ns": mtime_ns,
+		"chunk_size": chunk_size,
+		"chunks": chunks,
+		"root": root_digest(chunks),
+		"sha1": sha1_result[0],
+	}
+
+
+def save_manifest(image, manifest):
+	''' Writes the manifest next to the image '''
+
+	path = manifest_path(image)
+	temp_path = path + ".tmp"
+
+	with open(temp_path, 'w') as f:
+		json.dump(manifest, f)
+
+	os.replace(temp_path, path)
+
+
+def load_manifest(image):
+	'''
+	Returns the manifest stored next to the image, or None if there
+	isn't one or the image has changed since it was created
+	'''
+
+	try:
+		with open(manifest_path(image)) as f:
+			manifest = json.load(f)
+		stat = os.stat(image)
+	except (OSError, ValueError):
+		return None
+
+	if manifest.get("version") != manifest_version or manifest.get("size") != stat.st_size \
+		or manifest.get("mtime_ns") != stat.st_mtime_ns:
+		return None
+
+	if root_digest(manifest["chunks"]) != manifest["root"]:
+		return None
+
+	return manifest
+
+
+def get_manifest(image, chunk_size=default_chunk_size, workers=None):
+	''' Returns the image's manifest, creating and saving it if needed '''
+
+	manifest = load_manifest(image)
+
+	if manifest is None:
+		manifest = create_manifest(image, chunk_size, workers)
+		try:
+			save_manifest(image, manifest)
+		except OSError as err:
+			print("Unable to save the manifest for " + image + " : " + str(err))
+
+	return manifest
+
+
+def verify_device(device, manifest, sample=None, workers=None, backend=None, indexes=None):
+	'''
+	Reads the first manifest["size"] bytes of device back and compares
+	them with the manifest, chunks are read in parallel, through backend
+	if one is given
+
+	If indexes is given only those chunks are checked, otherwise if
+	sample is given only that many randomly chosen chunks are checked
+
+	Returns a sorted list of the indexes of chunks that don't match
+	'''
+
+	count = len(manifest["chunks"])
+
+	if indexes is None:
+		indexes = range(count)
+
+		if sample is not None and sample < count:
+			indexes = sorted(random.sample(range(count), sample))
+
+	if backend:
+		# Each read in flight should be a request at the drive, not a page cache hit
+		fd = open_direct(device, os.O_RDONLY)[0]
+	else:
+		fd = os.open(device, os.O_RDONLY)
+
+	try:
+		# Make sure we read what is on the drive rather than what we wrote to the cache
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		if backend:
+			digests = hash_chunks_queued(fd, manifest["size"], manifest["chunk_size"], indexes, backend)
+		else:
+			digests = hash_chunks(fd, manifest["size"], manifest["chunk_size"], indexes, workers)
+	finally:
+		os.close(fd)
+
+	return sorted(index for index, digest in digests.items() if digest != manifest["chunks"][index])
+
+
+def rewrite_chunks(image, device, manifest, indexes):
+	''' Copies the given chunks from the image to the device again '''
+
+	chunk_size = manifest["chunk_size"]
+
+	image_fd = os.open(image, os.O_RDONLY)
+	device_fd = os.open(device, os.O_WRONLY)
+
+	try:
+		for index in indexes:
+			offset = index * chunk_size
+			data = os.pread(image_fd, min(chunk_size, manifest["size"] - offset), offset)
+
+			view = memoryview(data)
+			while view:
+				count = os.pwrite(device_fd, view, offset)
+				view = view[count:]
+				offset += count
+
+		os.fsync(device_fd)
+	finally:
+		os.close(image_fd)
+		os.close(device_fd)
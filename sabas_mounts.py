@@ -0,0 +1,266 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+
+
+def _unescape(field):
+	''' Undoes the octal escaping of spaces, tabs etc used in /proc/self/mountinfo '''
+
+	if "\\" not in field:
+		return field
+
+	return field.encode("utf-8").decode("unicode_escape").encode("latin-1").decode("utf-8")
+
+
+def _read(path, default=""):
+	''' Returns the stripped contents of a small file such as a sysfs attribute '''
+
+	try:
+		with open(path) as f:
+			return f.read().strip()
+	except OSError:
+		return default
+
+
+class mount_index():
+	'''
+	An in-memory index of which block devices are mounted, used as swap
+	or held by another device (device-mapper, LVM, md)
+
+	Built in a single pass over /proc/self/mountinfo, /proc/swaps and
+	/sys/block so that the use of every drive can be answered without
+	spawning any processes. The roots can be changed so the index can
+	be built from a test fixture.
+	'''
+
+	def __init__(self, proc_root="/proc", sys_root="/sys", dev_root="/dev"):
+		self.proc_root = proc_root
+		self.sys_root = sys_root
+		self.dev_root = dev_root
+
+		self.refresh()
+
+	def refresh(self):
+		''' Rebuilds the index, call this after mounting or unmounting anything '''
+
+		# Kernel name -> parent disk name, disks are their own parent
+		self.parents = {}
+		# "major:minor" -> kernel name
+		self.devnums = {}
+		# Kernel name -> list of devices holding it
+		self.holders = {}
+		# Kernel name -> list of mount points
+		self.mounts = {}
+		# Kernel names in use as swap
+		self.swaps = set()
+		# Kernel names of disks attached by USB
+		self.usb_disks = set()
+
+		self._read_block_devices()
+		self._read_mountinfo()
+		self._read_swaps()
+		self._read_by_id()
+
+	def _read_block_devices(self):
+		block_root = os.path.join(self.sys_root, "block")
+
+		try:
+			disks = os.listdir(block_root)
+		except OSError:
+			disks = []
+
+		for disk in disks:
+			disk_path = os.path.join(block_root, disk)
+			self._add_device(disk, disk, disk_path)
+
+			try:
+				entries = os.listdir(disk_path)
+			except OSError:
+				continue
+
+			for entry in entries:
+				part_path = os.path.join(disk_path, entry)
+				if os.path.exists(os.path.join(part_path, "partition")):
+					self._add_device(entry, disk, part_path)
+
+	def _add_device(self, name, disk, path):
+		self.parents[name] = disk
+
+		devnum = _read(os.path.join(path, "dev"))
+		if devnum:
+			self.devnums[devnum] = name
+
+		try:
+			self.holders[name] = sorted(os.listdir(os.path.join(path, "holders")))
+		except OSError:
+			self.holders[name] = []
+
+	def _kernel_name(self, source, devnum=None):
+		''' Maps a device number or a path such as /dev/disk/by-label/X to a kernel name '''
+
+		if devnum in self.devnums:
+			return self.devnums[devnum]
+
+		if source.startswith("/dev/"):
+			resolved = os.path.realpath(os.path.join(self.dev_root, source[len("/dev/"):]))
+			name = os.path.basename(resolved)
+			if name in self.parents:
+				return name
+
+		return None
+
+	def _read_mountinfo(self):
+		lines = _read(os.path.join(self.proc_root, "self", "mountinfo")).splitlines()
+
+		for line in lines:
+			# The optional fields end with a lone "-", the mount source follows the filesystem type
+			pre, sep, post = line.partition(" - ")
+			if not sep:
+				continue
+
+			fields = pre.split()
+			post_fields = post.split()
+			if len(fields) < 5 or len(post_fields) < 2:
+				continue
+
+			name = self._kernel_name(_unescape(post_fields[1]), fields[2])
+			if name:
+				self.mounts.setdefault(name, []).append(_unescape(fields[4]))
+
+	def _read_swaps(self):
+		lines = _read(os.path.join(self.proc_root, "swaps")).splitlines()
+
+		# Skip the header line
+		for line in lines[1:]:
+			fields = line.split()
+			if fields:
+				name = self._kernel_name(_unescape(fields[0]))
+				if name:
+					self.swaps.add(name)
+
+	def _read_by_id(self):
+		by_id = os.path.join(self.dev_root, "disk", "by-id")
+
+		try:
+			links = os.listdir(by_id)
+		except OSError:
+			return
+
+		for link in links:
+			if link.startswith("usb-") and "-part" not in link:
+				try:
+					self.usb_disks.add(os.path.basename(os.readlink(os.path.join(by_id, link))))
+				except OSError:
+					continue
+
+	def _name(self, device):
+		''' Accepts /dev/sdX or sdX '''
+
+		return os.path.basename(device)
+
+	def partitions(self, device):
+		''' Returns the kernel names of the disk and all of its partitions '''
+
+		disk = self.parents.get(self._name(device), self._name(device))
+
+		return sorted(name for name, parent in self.parents.items() if parent == disk)
+
+	def users(self, device):
+		'''
+		Returns a list of (kernel name, kind, detail) tuples describing
+		everything using the disk or any of its partitions, where kind is
+		"mount", "swap" or "holder". Mounts and swaps of holding devices
+		such as LVM volumes are included.
+		'''
+
+		found = []
+		pending = self.partitions(device)
+		visited = set()
+
+		while pending:
+			name = pending.pop(0)
+			if name in visited:
+				continue
+			visited.add(name)
+
+			for mount_point in self.mounts.get(name, []):
+				found.append((name, "mount", mount_point))
+
+			if name in self.swaps:
+				found.append((name, "swap", "/dev/" + name))
+
+			for holder in self.holders.get(name, []):
+				found.append((name, "holder", holder))
+				pending.append(holder)
+
+		return found
+
+	def in_use(self, device):
+		''' Is any partition of the device in use '''
+
+		return len(self.users(device)) > 0
+
+	def busy_drives(self, devices):
+		''' Returns a dictionary of device -> users for all of the devices that are in use '''
+
+		busy = {}
+		for device in devices:
+			users = self.users(device)
+			if users:
+				busy[device] = users
+
+		return busy
+
+	def is_usb(self, device):
+		''' Is the disk attached by USB '''
+
+		return self.parents.get(self._name(device), self._name(device)) in self.usb_disks
+
+
+_libc = None
+
+def _get_libc():
+	global _libc
+
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+	return _libc
+
+
+def unmount(mount_point, lazy=False):
+	''' Unmounts the filesystem at mount_point using the umount2 system call '''
+
+	# MNT_DETACH
+	flags = 2 if lazy else 0
+
+	if _get_libc().umount2(os.fsencode(mount_point), flags) != 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err), mount_point)
+
+
+def swapoff(device):
+	''' Stops swapping to device using the swapoff system call '''
+
+	if _get_libc().swapoff(os.fsencode(device)) != 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err), device)
+
+
+def is_exclusive(device):
+	'''
+	Checks that nothing else has the block device open by opening it
+	with O_EXCL, which the kernel refuses with EBUSY for block devices
+	that are mounted or claimed by another driver
+	'''
+
+	try:
+		fd = os.open(device, os.O_RDONLY | os.O_EXCL)
+	except OSError as err:
+		if err.errno == errno.EBUSY:
+			return False
+		raise
+
+	os.close(fd)
+	return True
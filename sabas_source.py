@@ -0,0 +1,154 @@
+import os
+import sys
+import stat
+import time
+import queue
+import hashlib
+import threading
+import urllib.request
+
+from sabas_trace import trace
+
+
+# Size of each piece fetched from the source
+fetch_size = 1024 * 1024
+
+# Default amount fetched ahead of the writes
+default_readahead = 64 * 1024 * 1024
+
+# Seconds to wait on a stalled HTTP connection
+http_timeout = 60
+
+
+def is_url(spec):
+	return spec.startswith("http://") or spec.startswith("https://")
+
+
+def is_stream(spec):
+	''' Is spec stdin, a URL or a named pipe rather than a file that can be read more than once '''
+
+	if spec == "-" or is_url(spec):
+		return True
+
+	try:
+		return stat.S_ISFIFO(os.stat(spec).st_mode)
+	except OSError:
+		return False
+
+
+def source_exists(spec):
+	''' Can spec be used as an input, a file, stdin, a named pipe or a URL '''
+
+	return is_stream(spec) or os.path.isfile(spec)
+
+
+def open_stream(spec):
+	'''
+	Opens an image source, returns a tuple of (file object, size) where
+	size is None if it isn't known in advance
+	'''
+
+	if spec == "-":
+		return (sys.stdin.buffer, None)
+
+	if is_url(spec):
+		response = urllib.request.urlopen(spec, timeout=http_timeout)
+		length = response.headers.get("Content-Length")
+		return (response, int(length) if length and length.isdigit() else None)
+
+	f = open(spec, 'rb')
+	mode = os.fstat(f.fileno()).st_mode
+
+	return (f, os.fstat(f.fileno()).st_size if stat.S_ISREG(mode) else None)
+
+
+class readahead_source():
+	'''
+	Reads an image from a stream on a background thread, up to readahead
+	bytes ahead of the writes, so fetching overlaps with writing the
+	drive. The SHA1 and SHA256 of the data are calculated as it arrives.
+	'''
+
+	def __init__(self, spec, readahead=default_readahead):
+		self.spec = spec
+		self.stream, self.size = open_stream(spec)
+
+		self.chunks = queue.Queue(maxsize=max(1, readahead // fetch_size))
+		self.sha1 = hashlib.sha1()
+		self.sha256 = hashlib.sha256()
+		self.fetched = 0
+		self.error = None
+
+		self.leftover = memoryview(b"")
+		self.finished = False
+		self.stopping = False
+
+		self.thread = threading.Thread(target=self._fetch, name="sabas-fetch", daemon=True)
+		self.thread.start()
+
+	def _fetch(self):
+		try:
+			while not self.stopping:
+				with trace.span("fetch") as fetch_span:
+					data = self.stream.read(fetch_size)
+					fetch_span.set(bytes=len(data))
+
+				if not data:
+					break
+
+				self.sha1.update(data)
+				self.sha256.update(data)
+				self.fetched += len(data)
+				self.chunks.put(data)
+
+		except Exception as err:
+			self.error = err
+
+		# None marks the end of the stream
+		self.chunks.put(None)
+
+	def readinto(self, buffer):
+		'''
+		Fills buffer from the stream, waiting for data to arrive if
+		needed. Returns the number of bytes read, 0 at the end of the stream.
+		'''
+
+		view = memoryview(buffer)
+		count = 0
+
+		while count < len(view):
+			if not self.leftover:
+				if self.finished:
+					break
+
+				data = self.chunks.get()
+				if data is None:
+					self.finished = True
+					if self.error:
+						raise OSError("Error reading " + self.spec + " : " + str(self.error))
+					break
+				self.leftover = memoryview(data)
+
+			length = min(len(self.leftover), len(view) - count)
+			view[count:count + length] = self.leftover[:length]
+			self.leftover = self.leftover[length:]
+			count += length
+
+		return count
+
+	def close(self):
+		''' Stops fetching and closes the stream '''
+
+		self.stopping = True
+
+		# Unblock the fetch thread if it is waiting for space, a read
+		# blocked on a stalled pipe is left to the daemon thread
+		deadline = time.monotonic() + 5
+		while self.thread.is_alive() and time.monotonic() < deadline:
+			try:
+				self.chunks.get(timeout=0.1)
+			except queue.Empty:
+				pass
+
+		if self.stream is not sys.stdin.buffer:
+			self.stream.close()
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+
+
+'''
+Lightweight tracing of where the time goes when writing a drive
+
+Each phase, and each block of the hot loops, is recorded as a span
+with its start, duration, thread and any bytes processed. Traces are
+saved in the Chrome Trace Event format, open them in chrome://tracing
+or https://ui.perfetto.dev
+
+Tracing is off unless --trace FILE is passed or SABAS_TRACE=FILE is
+set, when off each span costs a single attribute check. A single
+phase can also be profiled with cProfile and tracemalloc by passing
+--profile PHASE or setting SABAS_PROFILE=PHASE. Only the first span of
+the phase is profiled, and cProfile only sees the thread that entered
+it, so for spans such as "hash chunk" that run on many threads at once
+the profile covers a single one of them.
+'''
+
+
+class null_span():
+	''' Stands in for a span when tracing is disabled '''
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+	def set(self, **args):
+		pass
+
+
+class span():
+	''' A single timed region of the trace '''
+
+	def __init__(self, tracer, name, args):
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+		self.profiler = None
+
+	def set(self, **args):
+		''' Adds arguments such as bytes processed to the span '''
+
+		self.args.update(args)
+
+	def __enter__(self):
+		if self.name == self.tracer.profile_phase:
+			self.profiler = self.tracer.start_profile()
+
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *exc):
+		end = time.perf_counter_ns()
+
+		if self.profiler:
+			self.tracer.stop_profile(self.profiler, self.name)
+
+		self.tracer.add_event({
+			"name": self.name,
+			"ph": "X",
+			"ts": (self.start - self.tracer.origin) / 1000,
+			"dur": (end - self.start) / 1000,
+			"pid": self.tracer.pid,
+			"tid": threading.get_native_id(),
+			"args": self.args,
+		})
+
+		return False
+
+
+class tracer():
+	'''
+	Collects spans from all threads and saves them as a Chrome trace
+	'''
+
+	def __init__(self):
+		self.enabled = False
+		self.path = None
+		self.profile_phase = None
+		# Set once the profiled phase has been entered, it is only profiled once
+		self.profile_started = False
+		self.events = []
+		self.lock = threading.Lock()
+		self.pid = os.getpid()
+		self.origin = time.perf_counter_ns()
+		self.null = null_span()
+
+		if os.environ.get("SABAS_TRACE"):
+			self.enable(os.environ["SABAS_TRACE"], os.environ.get("SABAS_PROFILE"))
+
+	def enable(self, path, profile_phase=None):
+		''' Starts recording spans, they are saved to path when the program exits '''
+
+		if not self.enabled:
+			atexit.register(self.save)
+
+		self.enabled = True
+		self.path = path
+		self.profile_phase = profile_phase
+		self.profile_started = False
+
+	def span(self, name, **args):
+		'''
+		Returns a context manager timing the code inside it
+
+			with trace.span("write", device=device) as s:
+				...
+				s.set(bytes=written)
+		'''
+
+		if not self.enabled:
+			return self.null
+
+		return span(self, name, args)
+
+	def phase(self, name):
+		''' Decorator that records every call of a function as a span '''
+
+		def decorator(function):
+			@functools.wraps(function)
+			def wrapper(*args, **kwargs):
+				if not self.enabled:
+					return function(*args, **kwargs)
+				with span(self, name, {}):
+					return function(*args, **kwargs)
+			return wrapper
+
+		return decorator
+
+	def add_event(self, event):
+		with self.lock:
+			self.events.append(event)
+
+	def start_profile(self):
+		''' Starts profiling the calling thread, returns None if the phase has already been profiled '''
+
+		import cProfile
+		import tracemalloc
+
+		with self.lock:
+			if self.profile_started:
+				return None
+			self.profile_started = True
+
+		tracemalloc.start()
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+		return profiler
+
+	def stop_profile(self, profiler, name):
+		''' Saves the cProfile stats and the top memory allocations of the profiled phase '''
+
+		import tracemalloc
+
+		profiler.disable()
+		snapshot = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+
+		base = (self.path or "sabas") + "." + name.replace(" ", "_")
+		profiler.dump_stats(base + ".prof")
+
+		with open(base + ".memory.txt", 'w') as f:
+			for stat in snapshot.statistics("lineno")[:50]:
+				f.write(str(stat) + "\n")
+
+	def save(self):
+		''' Writes the trace in the Chrome Trace Event JSON format '''
+
+		if not self.path:
+			return
+
+		with self.lock:
+			events = list(self.events)
+
+		# Name the threads so the trace viewer shows which pool they belong to
+		names = {}
+		for thread in threading.enumerate():
+			if thread.native_id is not None:
+				names[thread.native_id] = thread.name
+
+		for tid in set(event["tid"] for event in events):
+			events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+							"args": {"name": names.get(tid, "thread " + str(tid))}})
+
+		with open(self.path, 'w') as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# The tracer shared by all of sabas
+trace = tracer()
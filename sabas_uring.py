@@ -0,0 +1,161 @@
+import os
+import mmap
+import errno
+import ctypes
+import struct
+import platform
+
+
+'''
+A minimal io_uring binding using ctypes and the raw system calls
+
+Only what the queued I/O backend needs is implemented: a ring of a
+fixed size, READV and WRITEV requests and waiting for completions.
+Nothing needs to be installed, on kernels or sandboxes without
+io_uring creating a ring raises OSError so callers can fall back.
+'''
+
+# System call numbers, the same on every architecture since 5.1
+sys_io_uring_setup = 425
+sys_io_uring_enter = 426
+
+IORING_OFF_SQ_RING = 0
+IORING_OFF_CQ_RING = 0x8000000
+IORING_OFF_SQES = 0x10000000
+
+IORING_ENTER_GETEVENTS = 1
+
+IORING_OP_READV = 1
+IORING_OP_WRITEV = 2
+
+params_size = 120
+sqe_size = 64
+cqe_size = 16
+
+# opcode, flags, ioprio, fd, off, addr, len, rw_flags, user_data, then padding to 64 bytes
+sqe_format = "<BBHiQQIIQ24x"
+
+
+class iovec(ctypes.Structure):
+	_fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.syscall.restype = ctypes.c_long
+
+
+def supported():
+	'''
+	The ring is read and written from Python without memory barriers,
+	which is only safe on x86's strongly ordered memory
+	'''
+
+	return platform.machine() in ("x86_64", "AMD64", "i686", "i386")
+
+
+class io_uring():
+	''' A submission and completion queue pair shared with the kernel '''
+
+	def __init__(self, entries):
+		if not supported():
+			raise OSError(errno.ENOTSUP, "io_uring is only used on x86")
+
+		params = ctypes.create_string_buffer(params_size)
+		fd = _libc.syscall(ctypes.c_long(sys_io_uring_setup), ctypes.c_long(entries), params)
+
+		if fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, "io_uring_setup : " + os.strerror(err))
+
+		self.fd = fd
+		raw = params.raw
+
+		self.sq_entries, self.cq_entries = struct.unpack_from("<II", raw, 0)
+		sq_head, sq_tail, sq_mask, _, _, _, sq_array = struct.unpack_from("<7I", raw, 40)
+		cq_head, cq_tail, cq_mask, _, _, cqes = struct.unpack_from("<6I", raw, 80)
+
+		flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+		protection = mmap.PROT_READ | mmap.PROT_WRITE
+
+		try:
+			self.sq_ring = mmap.mmap(fd, sq_array + self.sq_entries * 4, flags, protection, offset=IORING_OFF_SQ_RING)
+			self.cq_ring = mmap.mmap(fd, cqes + self.cq_entries * cqe_size, flags, protection, offset=IORING_OFF_CQ_RING)
+			self.sqes = mmap.mmap(fd, self.sq_entries * sqe_size, flags, protection, offset=IORING_OFF_SQES)
+		except OSError:
+			os.close(fd)
+			raise
+
+		self.sq_head_offset = sq_head
+		self.sq_tail_offset = sq_tail
+		self.sq_array_offset = sq_array
+		self.sq_mask = struct.unpack_from("<I", self.sq_ring, sq_mask)[0]
+
+		self.cq_head_offset = cq_head
+		self.cq_tail_offset = cq_tail
+		self.cqes_offset = cqes
+		self.cq_mask = struct.unpack_from("<I", self.cq_ring, cq_mask)[0]
+
+		self.sq_tail = struct.unpack_from("<I", self.sq_ring, sq_tail)[0]
+		self.to_submit = 0
+
+		# Each submission slot has its own iovec, kept alive until the request completes
+		self.iovecs = (iovec * self.sq_entries)()
+
+	def prepare(self, opcode, fd, address, length, offset, user_data):
+		''' Adds a READV or WRITEV of length bytes at address to the submission queue '''
+
+		head = struct.unpack_from("<I", self.sq_ring, self.sq_head_offset)[0]
+		if (self.sq_tail - head) & 0xffffffff >= self.sq_entries:
+			raise OSError(errno.EBUSY, "io_uring submission queue is full")
+
+		index = self.sq_tail & self.sq_mask
+		self.iovecs[index].iov_base = address
+		self.iovecs[index].iov_len = length
+
+		struct.pack_into(sqe_format, self.sqes, index * sqe_size, opcode, 0, 0, fd, offset,
+						ctypes.addressof(self.iovecs[index]), 1, 0, user_data)
+		struct.pack_into("<I", self.sq_ring, self.sq_array_offset + index * 4, index)
+
+		# The kernel only looks at the tail during io_uring_enter, which orders these stores
+		self.sq_tail = (self.sq_tail + 1) & 0xffffffff
+		struct.pack_into("<I", self.sq_ring, self.sq_tail_offset, self.sq_tail)
+		self.to_submit += 1
+
+	def enter(self, wait_nr=0):
+		''' Submits the prepared requests and waits for at least wait_nr completions '''
+
+		flags = IORING_ENTER_GETEVENTS if wait_nr else 0
+
+		while True:
+			result = _libc.syscall(ctypes.c_long(sys_io_uring_enter), ctypes.c_long(self.fd),
+									ctypes.c_long(self.to_submit), ctypes.c_long(wait_nr),
+									ctypes.c_long(flags), None, ctypes.c_long(0))
+			if result >= 0:
+				self.to_submit -= result
+				return result
+
+			err = ctypes.get_errno()
+			if err != errno.EINTR:
+				raise OSError(err, "io_uring_enter : " + os.strerror(err))
+
+	def completions(self):
+		''' Returns (user_data, result) for every completed request, result is negative errno on failure '''
+
+		head = struct.unpack_from("<I", self.cq_ring, self.cq_head_offset)[0]
+		tail = struct.unpack_from("<I", self.cq_ring, self.cq_tail_offset)[0]
+
+		completed = []
+		while head != tail:
+			offset = self.cqes_offset + (head & self.cq_mask) * cqe_size
+			completed.append(struct.unpack_from("<Qi", self.cq_ring, offset))
+			head = (head + 1) & 0xffffffff
+
+		struct.pack_into("<I", self.cq_ring, self.cq_head_offset, head)
+
+		return completed
+
+	def close(self):
+		self.sq_ring.close()
+		self.cq_ring.close()
+		self.sqes.close()
+		os.close(self.fd)
@@ -0,0 +1,177 @@
+import os
+import lzma
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import sabas_capture
+from sabas_capture import capture_drive, last_used_byte, _regroup
+
+
+block_size = 64 * 1024
+
+
+class capture_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.drive = os.path.join(self.directory.name, "drive.img")
+
+		# Small blocks so the tests exercise many of them
+		for name, value in (("read_size", block_size), ("hole_size", 4096), ("compress_block_size", 3 * block_size)):
+			patch = mock.patch.object(sabas_capture, name, value)
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def path(self, name):
+		return os.path.join(self.directory.name, name)
+
+	def make_drive(self, size, extents):
+		''' Creates a drive image of zeros with random data at each (offset, length) '''
+
+		data = bytearray(size)
+		for offset, length in extents:
+			data[offset:offset + length] = os.urandom(length)
+
+		with open(self.drive, 'wb') as f:
+			f.write(data)
+
+		return bytes(data)
+
+	def test_sparse(self):
+		# Data straddling blocks and holes, an unaligned run and data right at the end
+		data = self.make_drive(20 * block_size + 1000, [(0, 5000), (3 * block_size - 10, 20), (7 * block_size + 4096, 3 * block_size),
+													(20 * block_size, 1000)])
+
+		read, stored = capture_drive(self.drive, self.path("out.img"))
+
+		with open(self.path("out.img"), 'rb') as f:
+			self.assertEqual(f.read(), data)
+
+		self.assertEqual(read, len(data))
+		self.assertLess(stored, 4 * block_size)
+		self.assertLess(os.stat(self.path("out.img")).st_blocks * 512, len(data))
+
+	def test_xz_round_trip(self):
+		# Whole zero compression blocks are only compressed once and must still come out in order
+		data = self.make_drive(40 * block_size + 333, [(0, block_size), (10 * block_size, 5), (30 * block_size, 10 * block_size + 333)])
+
+		read, stored = capture_drive(self.drive, self.path("out.img.xz"), threads=4)
+
+		with open(self.path("out.img.xz"), 'rb') as f:
+			compressed = f.read()
+
+		self.assertEqual(lzma.decompress(compressed), data)
+		self.assertEqual(stored, len(compressed))
+
+	def test_regroup(self):
+		blocks = [(0, b"a" * 5), (5, b"b" * 2), (7, b"c" * 9), (16, b"d")]
+
+		self.assertEqual(list(_regroup(blocks, 4)), [b"aaaa", b"abbc", b"cccc", b"cccc", b"d"])
+		self.assertEqual(list(_regroup([], 4)), [])
+
+	def test_zstd_missing_leaves_output_alone(self):
+		self.make_drive(block_size, [(0, 100)])
+		with open(self.path("out.zst"), 'wb') as f:
+			f.write(b"previous capture")
+
+		with mock.patch.object(sabas_capture, "zstandard", None):
+			with self.assertRaises(ValueError):
+				capture_drive(self.drive, self.path("out.zst"))
+
+		with open(self.path("out.zst"), 'rb') as f:
+			self.assertEqual(f.read(), b"previous capture")
+
+
+class trim_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.drive = os.path.join(self.directory.name, "drive.img")
+		self.size = 16 * 1024 * 1024
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def make_drive(self, partitions, gpt_partitions=None, iso_bytes=None):
+		'''
+		Creates a drive with an MBR of (type, start, count) partitions,
+		a GPT of (first, last) LBAs if gpt_partitions is given and a
+		primary volume descriptor of iso_bytes if given
+		'''
+
+		data = bytearray(self.size)
+
+		for i, (part_type, start, count) in enumerate(partitions):
+			entry = 446 + 16 * i
+			data[entry + 4] = part_type
+			struct.pack_into("<II", data, entry + 8, start, count)
+		data[510:512] = b'\x55\xaa'
+
+		if gpt_partitions is not None:
+			# Header in LBA 1, 128 entries of 128 bytes from LBA 2
+			data[512:520] = b'EFI PART'
+			struct.pack_into("<Q", data, 512 + 72, 2)
+			struct.pack_into("<II", data, 512 + 80, 128, 128)
+
+			for i, (first, last) in enumerate(gpt_partitions):
+				entry = 1024 + 128 * i
+				data[entry:entry + 16] = os.urandom(16)
+				struct.pack_into("<QQ", data, entry + 32, first, last)
+
+		if iso_bytes is not None:
+			descriptor = 16 * 2048
+			data[descriptor] = 1
+			data[descriptor + 1:descriptor + 6] = b'CD001'
+			struct.pack_into("<I", data, descriptor + 80, iso_bytes // 2048)
+			struct.pack_into("<H", data, descriptor + 128, 2048)
+
+		# Something past the partitions that a trimmed capture leaves out
+		data[-512:] = os.urandom(512)
+
+		with open(self.drive, 'wb') as f:
+			f.write(data)
+
+	def last_used(self):
+		fd = os.open(self.drive, os.O_RDONLY)
+		try:
+			return last_used_byte(fd)
+		finally:
+			os.close(fd)
+
+	def test_mbr(self):
+		self.make_drive([(0x0c, 2048, 4096), (0x83, 8192, 1000)])
+		self.assertEqual(self.last_used(), 9192 * 512)
+
+		output = os.path.join(self.directory.name, "out.img")
+		read, stored = capture_drive(self.drive, output, trim=True)
+
+		self.assertEqual(read, 9192 * 512)
+		self.assertEqual(os.path.getsize(output), 9192 * 512)
+
+	def test_gpt(self):
+		self.make_drive([(0xee, 1, self.size // 512 - 1)], [(2048, 10239), (10240, 12287)])
+		self.assertEqual(self.last_used(), 12288 * 512)
+
+	def test_gpt_without_header(self):
+		self.make_drive([(0xee, 1, self.size // 512 - 1)])
+		self.assertIsNone(self.last_used())
+
+	def test_hybrid_iso(self):
+		# The ISO filesystem goes on past the partition holding the EFI image
+		self.make_drive([(0xef, 100, 200)], iso_bytes=6 * 1024 * 1024)
+		self.assertEqual(self.last_used(), 6 * 1024 * 1024)
+
+	def test_no_partition_table(self):
+		with open(self.drive, 'wb') as f:
+			f.write(bytes(4096))
+
+		self.assertIsNone(self.last_used())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import hashlib
+import tempfile
+import unittest
+
+from sabas_catalog import sabas_catalog
+
+
+class catalog_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.catalog = sabas_catalog(os.path.join(self.directory.name, "catalog.db"))
+
+		self.images = os.path.join(self.directory.name, "images")
+		os.mkdir(self.images)
+		self.catalog.add_directory(self.images)
+
+	def tearDown(self):
+		self.catalog.close()
+		self.directory.cleanup()
+
+	def write_image(self, data, mtime_ns, name="test.iso"):
+		path = os.path.join(self.images, name)
+		with open(path, 'wb') as f:
+			f.write(data)
+		os.utime(path, ns=(mtime_ns, mtime_ns))
+		return path
+
+	def test_rescan_only_reads_changed_files(self):
+		self.write_image(b"a" * 4096, 10 ** 18)
+
+		self.assertEqual(self.catalog.scan(), (1, 0, 0, 0))
+		self.assertEqual(self.catalog.scan(), (0, 0, 0, 1))
+
+		self.write_image(b"b" * 8192, 2 * 10 ** 18)
+		self.assertEqual(self.catalog.scan(), (0, 1, 0, 0))
+
+	def test_sha1_follows_a_replaced_image(self):
+		self.write_image(b"a" * 4096, 10 ** 18)
+		self.catalog.scan(hash_files=True)
+		image_id = self.catalog.search("test")[0]["id"]
+
+		self.assertEqual(self.catalog.get_sha1(image_id), hashlib.sha1(b"a" * 4096).hexdigest())
+
+		# Replaced on the share without a rescan, same size but a new mtime
+		self.write_image(b"c" * 4096, 2 * 10 ** 18)
+
+		self.assertEqual(self.catalog.get_sha1(image_id), hashlib.sha1(b"c" * 4096).hexdigest())
+		self.assertEqual(self.catalog.scan(), (0, 0, 0, 1))
+
+	def test_unreadable_directory_keeps_its_images(self):
+		self.write_image(b"a" * 4096, 10 ** 18)
+		self.catalog.scan(hash_files=True)
+		row = self.catalog.search("test")[0]
+
+		# The share isn't mounted
+		os.rename(self.images, self.images + ".away")
+		self.assertEqual(self.catalog.scan(), (0, 0, 0, 0))
+
+		os.rename(self.images + ".away", self.images)
+		self.assertEqual(self.catalog.scan(), (0, 0, 0, 1))
+		self.assertEqual(self.catalog.get(row["id"])["sha1"], row["sha1"])
+
+	def test_ids_are_not_reused(self):
+		path = self.write_image(b"a" * 4096, 10 ** 18, "first.iso")
+		self.catalog.scan()
+		first_id = self.catalog.search("first")[0]["id"]
+
+		os.remove(path)
+		self.catalog.scan()
+		self.write_image(b"b" * 4096, 10 ** 18, "second.iso")
+		self.catalog.scan()
+
+		self.assertGreater(self.catalog.search("second")[0]["id"], first_id)
+		with self.assertRaises(ValueError):
+			self.catalog.get(first_id)
+
+	def test_search_is_literal(self):
+		self.write_image(b"a" * 4096, 10 ** 18, "debian_12.iso")
+		self.write_image(b"b" * 4096, 10 ** 18, "fedora-40.iso")
+		self.write_image(b"c" * 4096, 10 ** 18, "100%.img")
+		self.catalog.scan()
+
+		self.assertEqual([row["name"] for row in self.catalog.search("_")], ["debian_12.iso"])
+		self.assertEqual([row["name"] for row in self.catalog.search("%")], ["100%.img"])
+		self.assertEqual(len(self.catalog.search("")), 3)
+
+	def test_upgrade_keeps_entries(self):
+		self.catalog.close()
+		path = os.path.join(self.directory.name, "old.db")
+
+		# The schema before IDs were AUTOINCREMENT
+		db = sqlite3.connect(path)
+		db.executescript(sabas_catalog.schema.replace("AUTOINCREMENT", ""))
+		with db:
+			db.execute("INSERT INTO images (id, path, directory, name, size, mtime_ns) VALUES (7, '/a.iso', '/', 'a.iso', 1, 1)")
+		db.close()
+
+		self.catalog = sabas_catalog(path)
+		self.assertEqual(self.catalog.get(7)["name"], "a.iso")
+
+		sql = self.catalog.db.execute("SELECT sql FROM sqlite_master WHERE name = 'images'").fetchone()[0]
+		self.assertIn("AUTOINCREMENT", sql)
+
+
+if __name__ == "__main__":
+	unittest.main()
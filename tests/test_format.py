@@ -0,0 +1,94 @@
+import time
+import threading
+import subprocess
+import unittest
+from unittest import mock
+
+import sabas_format
+from sabas_format import format_drive, bulk_format, partition_path
+
+
+class format_test(unittest.TestCase):
+	''' Runs the format pipeline with run_step and wait_for_partition patched, so nothing is touched '''
+
+	def setUp(self):
+		self.lock = threading.Lock()
+		# (device, step) in the order they ran
+		self.calls = []
+		self.running = set()
+		self.peak = 0
+		self.fail = {}
+
+		patches = [mock.patch.object(sabas_format, "run_step", self.run_step),
+					mock.patch.object(sabas_format, "wait_for_partition", self.wait_for_partition)]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def run_step(self, command, input_text=None):
+		device = command[-1].rstrip("0123456789")
+		step = {"wipefs": "wipe", "sfdisk": "partition"}.get(command[0], "format")
+
+		with self.lock:
+			self.calls.append((device, command[0]))
+			self.running.add(device)
+			self.peak = max(self.peak, len(self.running))
+
+		time.sleep(0.01)
+
+		with self.lock:
+			self.running.discard(device)
+
+		if self.fail.get(device) == step:
+			raise subprocess.CalledProcessError(1, command, output="no medium found\n")
+
+	def wait_for_partition(self, partition, timeout=None):
+		with self.lock:
+			self.calls.append((partition.rstrip("0123456789"), "wait"))
+
+	def test_steps_run_in_order(self):
+		timings = format_drive("/dev/sdb", "fat32")
+
+		self.assertEqual([call[1] for call in self.calls], ["wipefs", "sfdisk", "wait", "mkfs.vfat"])
+		self.assertEqual([timing[0] for timing in timings], ["wipe", "partition", "format"])
+
+	def test_partition_path(self):
+		self.assertEqual(partition_path("/dev/sdb"), "/dev/sdb1")
+		self.assertEqual(partition_path("/dev/mmcblk0"), "/dev/mmcblk0p1")
+
+	def test_parallel_is_bounded(self):
+		devices = ["/dev/sd" + letter for letter in "bcdefghijk"]
+		results = bulk_format(devices, "exfat", max_parallel=3)
+
+		self.assertEqual(sorted(results), devices)
+		self.assertLessEqual(self.peak, 3)
+		self.assertGreater(self.peak, 1)
+
+		# Each drive's own steps still ran in order
+		for device in devices:
+			steps = [call[1] for call in self.calls if call[0] == device]
+			self.assertEqual(steps, ["wipefs", "sfdisk", "wait", "mkfs.exfat"])
+
+	def test_failure_is_reported_with_earlier_timings(self):
+		self.fail["/dev/sdc"] = "partition"
+		reported = []
+
+		results = bulk_format(["/dev/sdb", "/dev/sdc", "/dev/sdd"], "ntfs", max_parallel=2,
+							progress=lambda device, timings, error: reported.append(device))
+
+		self.assertEqual(sorted(reported), ["/dev/sdb", "/dev/sdc", "/dev/sdd"])
+		self.assertIsNone(results["/dev/sdb"][1])
+		self.assertIsNone(results["/dev/sdd"][1])
+		self.assertEqual(len(results["/dev/sdd"][0]), 3)
+
+		timings, error = results["/dev/sdc"]
+		self.assertEqual([timing[0] for timing in timings], ["wipe"])
+		self.assertTrue(error.startswith("partition step failed"))
+		self.assertIn("no medium found", error)
+
+		# Nothing after the failed step ran on that drive
+		self.assertNotIn(("/dev/sdc", "mkfs.ntfs"), self.calls)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+
+from sabas_health import health_check, difference_cover, alias_probes
+
+
+# Small samples keep the simulated drives in memory, the checks only depend on the number of blocks
+sample_size = 64 * 1024
+blocks = 1024
+
+
+class wrapping_drive():
+	''' A drive that reports capacity bytes but stores offset at offset % real, as counterfeit flash does '''
+
+	def __init__(self, capacity, real):
+		self.capacity = capacity
+		self.real = real
+		self.data = bytearray(real)
+
+	def pwrite(self, buffer, offset):
+		data = bytes(buffer)
+		done = 0
+
+		while done < len(data):
+			position = (offset + done) % self.real
+			length = min(len(data) - done, self.real - position)
+			self.data[position:position + length] = data[done:done + length]
+			done += length
+
+		return len(data)
+
+	def pread_into(self, buffer, offset):
+		view = memoryview(buffer)
+		done = 0
+
+		while done < len(view):
+			position = (offset + done) % self.real
+			length = min(len(view) - done, self.real - position)
+			view[done:done + length] = self.data[position:position + length]
+			done += length
+
+		return len(view)
+
+	def close(self):
+		pass
+
+
+class difference_cover_test(unittest.TestCase):
+
+	def test_covers_upper_half(self):
+		for size in range(1, 600):
+			cover = sorted(difference_cover(size))
+			differences = {b - a for a in cover for b in cover}
+
+			self.assertTrue(all(0 <= block < size for block in cover))
+			self.assertTrue(set(range(size // 2, size)) <= differences, size)
+
+	def test_probe_count_grows_with_square_root(self):
+		probes, checkpoints = alias_probes(64 * 2 ** 30)
+
+		self.assertLess(len(probes), 1000)
+		self.assertEqual(checkpoints[-1], 64 * 2 ** 30)
+
+
+class health_check_test(unittest.TestCase):
+
+	def check(self, real_blocks):
+		drive = wrapping_drive(blocks * sample_size, real_blocks * sample_size)
+		return health_check(drive, sample_size=sample_size)
+
+	def test_wraparound_is_always_caught(self):
+		reals = sorted(set(range(1, blocks, 7)) | {100, 192, 322, 396, 433, 470, 581, 618, 988, 1023})
+
+		for real in reals:
+			report = self.check(real)
+
+			self.assertTrue(report.failures(), real)
+			self.assertTrue(report.wraps_around(), real)
+
+			# Never more than really exists, and no less than the power of two below it
+			usable = report.usable_capacity()
+			self.assertLessEqual(usable, real * sample_size, real)
+			self.assertGreaterEqual(usable, 2 ** (real.bit_length() - 1) * sample_size, real)
+
+	def test_genuine_drive_passes(self):
+		report = self.check(blocks)
+
+		self.assertEqual(report.failures(), [])
+		self.assertFalse(report.wraps_around())
+		self.assertEqual(report.usable_capacity(), blocks * sample_size)
+
+	def test_exhaustive_finds_the_real_capacity(self):
+		drive = wrapping_drive(256 * sample_size, 100 * sample_size)
+		report = health_check(drive, sample_size=sample_size, exhaustive=True)
+
+		self.assertEqual(report.usable_capacity(), 100 * sample_size)
+
+	def test_file(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "drive.img")
+			with open(path, 'wb') as f:
+				f.truncate(64 * sample_size)
+
+			report = health_check(path, sample_size=sample_size)
+
+		self.assertEqual(report.failures(), [])
+		self.assertTrue(all(region is not None for region in report.regions()))
+
+
+if __name__ == "__main__":
+	unittest.main()
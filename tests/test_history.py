@@ -0,0 +1,117 @@
+import os
+import time
+import tempfile
+import unittest
+
+from sabas_history import throughput_history, throughput_recorder, time_at, format_eta
+
+
+model = ("Acme", "Stick 3.0", "")
+
+
+def recorder_at(samples):
+	''' A recorder part way through a job, samples are (bytes, seconds) '''
+
+	recorder = throughput_recorder()
+	recorder.samples = list(samples)
+	recorder.start = time.monotonic() - samples[-1][1]
+	return recorder
+
+
+# Fast while the drive's cache fills, then a tenth of the speed
+cached_curve = [(0, 0.0), (1000, 10.0), (3000, 210.0), (4000, 310.0)]
+
+
+class history_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.history = throughput_history(os.path.join(self.directory.name, "history.db"))
+
+	def tearDown(self):
+		self.history.close()
+		self.directory.cleanup()
+
+	def add_jobs(self, identity, curve, count=3, job_type="iso"):
+		for i in range(count):
+			self.history.record(identity, job_type, recorder_at(curve))
+
+	def test_time_at(self):
+		self.assertEqual(time_at(cached_curve, 500), 5.0)
+		self.assertEqual(time_at(cached_curve, 2500), 160.0)
+		# Beyond the curve the rate over its last quarter is used
+		self.assertEqual(time_at(cached_curve, 5000), 410.0)
+
+	def test_predict_eta_follows_the_model_curve(self):
+		self.add_jobs(model, cached_curve)
+
+		# The same speed as before, the slow part is still to come
+		same = recorder_at([(0, 0.0), (500, 5.0)])
+		self.assertAlmostEqual(self.history.predict_eta(model, "iso", same, 4000), 305.0, places=1)
+
+		# Half the speed of the previous jobs
+		slower = recorder_at([(0, 0.0), (500, 10.0)])
+		self.assertAlmostEqual(self.history.predict_eta(model, "iso", slower, 4000), 610.0, places=1)
+
+		self.assertEqual(self.history.predict_eta(model, "iso", recorder_at([(0, 0.0), (4000, 300.0)]), 4000), 0)
+
+	def test_predict_eta_uses_other_image_types(self):
+		self.add_jobs(model, cached_curve, job_type="img")
+
+		recorder = recorder_at([(0, 0.0), (500, 5.0)])
+		self.assertAlmostEqual(self.history.predict_eta(model, "iso", recorder, 4000), 305.0, places=1)
+
+	def test_predict_eta_without_history(self):
+		# Too early to say
+		self.assertIsNone(self.history.predict_eta(model, "iso", recorder_at([(0, 0.0), (100, 1.0)]), 4000))
+
+		# Falls back to the rate over the second half of the job so far
+		recorder = recorder_at([(0, 0.0), (500, 1.0), (1000, 6.0), (2000, 16.0)])
+		self.assertAlmostEqual(self.history.predict_eta(model, "iso", recorder, 4000), 20.0, places=1)
+
+	def test_is_slow(self):
+		# Not enough history to compare with
+		self.add_jobs(model, cached_curve, count=2)
+		self.assertFalse(self.history.is_slow(model, "iso", 1.0))
+
+		self.add_jobs(model, cached_curve, count=1)
+		expected = 4000 / 310.0
+		self.assertAlmostEqual(self.history.model_throughput(model, "iso"), expected)
+		self.assertTrue(self.history.is_slow(model, "iso", expected * 0.4))
+		self.assertFalse(self.history.is_slow(model, "iso", expected * 0.6))
+
+	def test_order_slowest_first(self):
+		fast = ("Acme", "Fast", "")
+		slow = ("Acme", "Slow", "")
+		self.add_jobs(fast, [(0, 0.0), (1000, 10.0)])
+		self.add_jobs(slow, [(0, 0.0), (1000, 100.0)])
+
+		# A drive with its own history is judged by it rather than its model's
+		worn = ("Acme", "Fast", "worn")
+		self.history.record(worn, "iso", recorder_at([(0, 0.0), (1000, 50.0)]))
+
+		drives = [("/dev/sdb", fast), ("/dev/sdc", slow), ("/dev/sdd", ("Other", "New", "")), ("/dev/sde", worn)]
+		ordered = [device for device, identity in self.history.order_slowest_first(drives, "iso")]
+
+		self.assertEqual(ordered, ["/dev/sdd", "/dev/sdc", "/dev/sde", "/dev/sdb"])
+
+	def test_single_point_job(self):
+		# dd jobs are recorded with only their start and end
+		recorder = throughput_recorder()
+		recorder.start -= 10
+		recorder.finish(1000)
+		self.history.record(model, "iso", recorder)
+
+		serial, job_bytes, seconds, curve = self.history.jobs(model, "iso")[0]
+		self.assertEqual(job_bytes, 1000)
+		self.assertEqual(len(curve), 2)
+
+	def test_format_eta(self):
+		self.assertEqual(format_eta(None), "estimating...")
+		self.assertEqual(format_eta(45), "45s")
+		self.assertEqual(format_eta(200), "3m 20s")
+		self.assertEqual(format_eta(7300), "2h 1m")
+
+
+if __name__ == "__main__":
+	unittest.main()
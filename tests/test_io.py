@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from sabas_io import copy_image_queued, get_backend, sequential_backend, thread_backend
+from sabas_manifest import create_manifest, verify_device
+
+
+block_size = 256 * 1024
+
+
+class copy_queued_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.source = os.path.join(self.directory.name, "source.img")
+		self.target = os.path.join(self.directory.name, "target.img")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def backends(self):
+		yield sequential_backend()
+		yield thread_backend(4)
+		try:
+			yield get_backend("io_uring", 4)
+		except OSError:
+			pass
+
+	def test_unaligned_sizes(self):
+		# Empty, shorter than a page, aligned, a whole block and with an unaligned tail
+		for size in (0, 100, 4096, block_size, 3 * block_size + 12345):
+			data = os.urandom(size)
+			with open(self.source, 'wb') as f:
+				f.write(data)
+
+			for backend in self.backends():
+				# A larger target must be cut down to the image
+				with open(self.target, 'wb') as f:
+					f.write(b"x" * (size + 10000))
+
+				written = copy_image_queued(self.source, self.target, backend, block_size)
+
+				self.assertEqual(written, size)
+				with open(self.target, 'rb') as f:
+					self.assertEqual(f.read(), data, (size, backend.name))
+
+	def test_verify_through_backends(self):
+		with open(self.source, 'wb') as f:
+			f.write(os.urandom(5 * block_size + 777))
+
+		manifest = create_manifest(self.source, block_size)
+		copy_image_queued(self.source, self.target, thread_backend(4), block_size)
+
+		for backend in self.backends():
+			self.assertEqual(verify_device(self.target, manifest, backend=backend), [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,88 @@
+import os
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import sabas_manifest
+from sabas_manifest import create_manifest, verify_device, rewrite_chunks
+
+
+chunk_size = 64 * 1024
+
+
+class manifest_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.image = os.path.join(self.directory.name, "test.img")
+		self.device = os.path.join(self.directory.name, "device.img")
+
+		self.data = os.urandom(10 * chunk_size + 1000)
+		with open(self.image, 'wb') as f:
+			f.write(self.data)
+		with open(self.device, 'wb') as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def corrupt(self, index):
+		with open(self.device, 'r+b') as f:
+			f.seek(index * chunk_size)
+			f.write(b"x" * 16)
+
+	def test_manifest(self):
+		manifest = create_manifest(self.image, chunk_size, workers=4)
+
+		self.assertEqual(len(manifest["chunks"]), 11)
+		self.assertEqual(manifest["sha1"], hashlib.sha1(self.data).hexdigest())
+		self.assertEqual(verify_device(self.device, manifest), [])
+
+	def test_repair(self):
+		manifest = create_manifest(self.image, chunk_size)
+		self.corrupt(3)
+		self.corrupt(10)
+
+		mismatched = verify_device(self.device, manifest)
+		self.assertEqual(mismatched, [3, 10])
+
+		rewrite_chunks(self.image, self.device, manifest, mismatched)
+		self.assertEqual(verify_device(self.device, manifest, indexes=mismatched), [])
+
+	def test_indexes_only_reads_those_chunks(self):
+		manifest = create_manifest(self.image, chunk_size)
+		self.corrupt(3)
+
+		self.assertEqual(verify_device(self.device, manifest, indexes=[2, 4]), [])
+		self.assertEqual(verify_device(self.device, manifest, indexes=[3]), [3])
+
+	def test_failed_hash_waits_for_sha1(self):
+		started = threading.Event()
+		sequential_sha1 = sabas_manifest.sequential_sha1
+
+		def slow_sha1(fd, size, result):
+			started.set()
+			threading.Event().wait(0.2)
+			sequential_sha1(fd, size, result)
+
+		def failing_hash(*args, **kwargs):
+			started.wait()
+			raise OSError("read failed")
+
+		errors = []
+		def excepthook(args):
+			errors.append(args.exc_value)
+
+		with mock.patch.object(sabas_manifest, "sequential_sha1", slow_sha1), \
+			mock.patch.object(sabas_manifest, "hash_chunks", failing_hash), \
+			mock.patch.object(threading, "excepthook", excepthook):
+			with self.assertRaises(OSError):
+				create_manifest(self.image, chunk_size)
+
+		self.assertEqual(errors, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,171 @@
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+import sabas_core
+from sabas_mounts import mount_index
+
+
+mountinfo = r'''22 1 252:1 / / rw,relatime shared:1 - ext4 /dev/vda1 rw
+36 22 0:45 / /media/user/MY\040STICK rw,nosuid,nodev,relatime shared:40 - vfat /dev/disk/by-label/MY\040STICK rw,fmask=0022
+37 22 253:0 / /data rw,relatime shared:41 - ext4 /dev/mapper/vg-data rw
+'''
+
+swaps = '''Filename				Type		Size		Used		Priority
+/dev/sdd2                               partition	1048572		0		-2
+/dev/dm-1                               partition	1048572		0		-3
+'''
+
+
+class mount_fixture(unittest.TestCase):
+	'''
+	Builds the index from a fixture tree with a USB stick mounted by its
+	label, a swap partition and a partition under LVM
+	'''
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.root = self.directory.name
+
+		self.add_device("vda", "252:0")
+		self.add_device("vda/vda1", "252:1")
+		self.add_device("sdb", "8:16")
+		self.add_device("sdb/sdb1", "8:17")
+		self.add_device("sdc", "8:32")
+		self.add_device("sdc/sdc1", "8:33", holders=["dm-0"])
+		self.add_device("dm-0", "253:0", holders=["dm-1"])
+		self.add_device("dm-1", "253:1")
+		self.add_device("sdd", "8:48")
+		self.add_device("sdd/sdd1", "8:49")
+		self.add_device("sdd/sdd2", "8:50")
+		self.add_device("sde", "8:64")
+
+		self.write("proc/self/mountinfo", mountinfo)
+		self.write("proc/swaps", swaps)
+
+		self.link("dev/disk/by-label/MY STICK", "../../sdb1")
+		self.link("dev/disk/by-id/usb-Acme_Stick_0123-0:0", "../../sdb")
+		self.link("dev/disk/by-id/usb-Acme_Stick_0123-0:0-part1", "../../sdb1")
+		self.link("dev/disk/by-id/usb-Acme_Stick_4567-0:0", "../../sde")
+		self.link("dev/disk/by-id/ata-Disk_89AB", "../../sdc")
+
+		self.index = mount_index(*(os.path.join(self.root, name) for name in ("proc", "sys", "dev")))
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write(self, path, text):
+		path = os.path.join(self.root, path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'w') as f:
+			f.write(text)
+
+	def link(self, path, target):
+		path = os.path.join(self.root, path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		os.symlink(target, path)
+
+	def add_device(self, path, devnum, holders=()):
+		device = os.path.join("sys/block", path)
+
+		self.write(os.path.join(device, "dev"), devnum + "\n")
+		os.makedirs(os.path.join(self.root, device, "holders"))
+		for holder in holders:
+			os.symlink("../../" + holder, os.path.join(self.root, device, "holders", holder))
+
+		if "/" in path:
+			self.write(os.path.join(device, "partition"), "1\n")
+
+
+
+class mount_index_test(mount_fixture):
+
+	def test_label_mount(self):
+		self.assertEqual(self.index.users("/dev/sdb"), [("sdb1", "mount", "/media/user/MY STICK")])
+		self.assertEqual(self.index.partitions("/dev/sdb"), ["sdb", "sdb1"])
+
+	def test_swap_partition(self):
+		self.assertEqual(self.index.users("/dev/sdd"), [("sdd2", "swap", "/dev/sdd2")])
+
+	def test_holder_chain(self):
+		self.assertEqual(self.index.users("/dev/sdc"), [
+			("sdc1", "holder", "dm-0"),
+			("dm-0", "mount", "/data"),
+			("dm-0", "holder", "dm-1"),
+			("dm-1", "swap", "/dev/dm-1"),
+		])
+
+	def test_busy_drives(self):
+		busy = self.index.busy_drives(["/dev/sdb", "/dev/sdc", "/dev/sdd", "/dev/sde"])
+
+		self.assertEqual(sorted(busy), ["/dev/sdb", "/dev/sdc", "/dev/sdd"])
+		self.assertFalse(self.index.in_use("/dev/sde"))
+		self.assertTrue(self.index.in_use("sdb1"))
+
+	def test_usb(self):
+		self.assertTrue(self.index.is_usb("/dev/sdb"))
+		self.assertTrue(self.index.is_usb("/dev/sdb1"))
+		self.assertTrue(self.index.is_usb("/dev/sde"))
+		self.assertFalse(self.index.is_usb("/dev/sdc"))
+
+	def test_refresh(self):
+		self.write("proc/self/mountinfo", mountinfo.splitlines()[0] + "\n")
+		self.index.refresh()
+
+		self.assertFalse(self.index.in_use("/dev/sdb"))
+		self.assertTrue(self.index.in_use("/dev/sdd"))
+
+
+class mount_checks_test(mount_fixture):
+	''' Runs the drive checks against the fixture, without unmounting anything real '''
+
+	def setUp(self):
+		super().setUp()
+
+		handler = signal.getsignal(signal.SIGINT)
+		self.core = sabas_core.sabas_core()
+		signal.signal(signal.SIGINT, handler)
+
+		self.core.get_mount_index = lambda: self.index
+
+		patches = [mock.patch.object(sabas_core, name) for name in ("unmount", "swapoff", "is_exclusive")]
+		self.unmount, self.swapoff, self.is_exclusive = [patch.start() for patch in patches]
+		for patch in patches:
+			self.addCleanup(patch.stop)
+
+	def test_held_drive_is_left_alone(self):
+		with self.assertRaises(ValueError):
+			self.core.mount_checks("/dev/sdc")
+
+		self.unmount.assert_not_called()
+		self.swapoff.assert_not_called()
+
+	def test_own_partitions_are_released(self):
+		# The fixture still lists the mount and swap afterwards, so the drive is reported as still in use
+		with self.assertRaises(ValueError):
+			self.core.mount_checks("/dev/sdb")
+		self.unmount.assert_called_once_with("/media/user/MY STICK")
+
+		with self.assertRaises(ValueError):
+			self.core.mount_checks("/dev/sdd")
+		self.swapoff.assert_called_once_with("/dev/sdd2")
+
+	def test_unused_drive(self):
+		self.is_exclusive.return_value = True
+		self.core.mount_checks("/dev/sde")
+
+	def test_run_rejects_a_hard_drive_before_touching_it(self):
+		self.core.find_drives = lambda: None
+		self.core.cline_flag = True
+		self.core.selection = "/dev/sdd"
+
+		with self.assertRaises(ValueError):
+			self.core.run()
+
+		self.swapoff.assert_not_called()
+
+
+if __name__ == "__main__":
+	unittest.main()
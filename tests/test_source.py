@@ -0,0 +1,116 @@
+import os
+import signal
+import hashlib
+import tempfile
+import threading
+import unittest
+import http.server
+from unittest import mock
+
+from sabas_core import sabas_core
+from sabas_io import copy_queued, sequential_backend, thread_backend
+from sabas_source import readahead_source, is_stream, source_exists
+
+
+image = os.urandom(5 * 1024 * 1024 + 777)
+
+
+class image_handler(http.server.BaseHTTPRequestHandler):
+	''' Serves the image, /chunked without a Content-Length so its size isn't known until it ends '''
+
+	def do_GET(self):
+		self.send_response(200)
+		if self.path != "/chunked":
+			self.send_header("Content-Length", str(len(image)))
+		self.end_headers()
+
+		for start in range(0, len(image), 65536):
+			self.wfile.write(image[start:start + 65536])
+
+	def log_message(self, *args):
+		pass
+
+
+class stream_test(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		# HTTP/1.0 closes the connection after each response, which ends the chunked stream
+		cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), image_handler)
+		cls.url = "http://127.0.0.1:" + str(cls.server.server_address[1])
+		cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+		cls.thread.start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.target = os.path.join(self.directory.name, "target.img")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write(self, spec, backend):
+		source = readahead_source(spec, readahead=1024 * 1024)
+
+		try:
+			written = copy_queued(lambda buffer, offset: source.readinto(buffer), self.target, backend, 1024 * 1024)
+		finally:
+			source.close()
+
+		with open(self.target, 'rb') as f:
+			self.assertEqual(f.read(), image)
+
+		self.assertEqual(written, len(image))
+		self.assertEqual(source.sha1.hexdigest(), hashlib.sha1(image).hexdigest())
+		self.assertEqual(source.sha256.hexdigest(), hashlib.sha256(image).hexdigest())
+
+		return source
+
+	def test_url_with_length(self):
+		source = self.write(self.url + "/image.iso", thread_backend(4))
+		self.assertEqual(source.size, len(image))
+
+	def test_url_without_length(self):
+		source = self.write(self.url + "/chunked", sequential_backend())
+		self.assertIsNone(source.size)
+
+	def test_named_pipe(self):
+		pipe = os.path.join(self.directory.name, "pipe")
+		os.mkfifo(pipe)
+
+		def feed():
+			with open(pipe, 'wb') as f:
+				f.write(image)
+
+		feeder = threading.Thread(target=feed)
+		feeder.start()
+
+		self.assertTrue(is_stream(pipe))
+		self.write(pipe, thread_backend(4))
+		feeder.join()
+
+	def test_sources(self):
+		self.assertTrue(source_exists("-"))
+		self.assertTrue(source_exists(self.url + "/image.iso"))
+		self.assertFalse(is_stream(__file__))
+		self.assertFalse(source_exists(os.path.join(self.directory.name, "missing.iso")))
+
+	def test_stdin_without_terminal(self):
+		handler = signal.getsignal(signal.SIGINT)
+		core = sabas_core()
+		signal.signal(signal.SIGINT, handler)
+
+		core.iso_filename = "-"
+		core.selection = self.target
+
+		with mock.patch("builtins.open", side_effect=OSError(6, "No such device or address")):
+			with self.assertRaises(ValueError):
+				core.write_cline()
+
+
+if __name__ == "__main__":
+	unittest.main()
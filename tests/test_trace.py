@@ -0,0 +1,47 @@
+import os
+import json
+import tempfile
+import unittest
+
+from sabas_trace import trace
+from sabas_manifest import create_manifest
+
+
+class trace_test(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "trace.json")
+
+		self.image = os.path.join(self.directory.name, "test.img")
+		with open(self.image, 'wb') as f:
+			f.write(os.urandom(4 * 1024 * 1024))
+
+	def tearDown(self):
+		trace.enabled = False
+		trace.path = None
+		trace.profile_phase = None
+		trace.profile_started = False
+		trace.events = []
+		self.directory.cleanup()
+
+	def test_trace(self):
+		trace.enable(self.path)
+		create_manifest(self.image, 64 * 1024, workers=8)
+		trace.save()
+
+		with open(self.path) as f:
+			events = json.load(f)["traceEvents"]
+
+		self.assertEqual(len([event for event in events if event["name"] == "hash chunk"]), 64)
+
+	def test_profile_concurrent_phase(self):
+		trace.enable(self.path, "hash chunk")
+		create_manifest(self.image, 64 * 1024, workers=8)
+
+		self.assertTrue(os.path.exists(self.path + ".hash_chunk.prof"))
+		self.assertTrue(os.path.exists(self.path + ".hash_chunk.memory.txt"))
+
+
+if __name__ == "__main__":
+	unittest.main()